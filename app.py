@@ -1,21 +1,43 @@
 import pandas as pd
 import numpy as np
 from plotly import tools
+import plotly.utils
 import pysal as ps   
-from libpysal.weights.contiguity import Queen
-import giddy
 from giddy import mobility
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output , State
-from scipy import stats
+from dash.dependencies import Input, Output , State, ClientsideFunction
 from scipy.stats import rankdata
+import scipy.sparse
+import scipy.spatial
 import geopandas as gpd
 import base64 
 import string
+import re
 import math
+import copy
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import collections
+import functools
+import contextlib
+import sqlite3
+import pickle
+import time
+import multiprocessing
+import multiprocessing.util
+import concurrent.futures
+import libpysal
 import matplotlib.cm
+try:
+    import fcntl
+except ImportError: # No file locks (Windows): concurrent figures are only coalesced within each worker
+    fcntl = None
 
 # https://github.com/plotly/dash/issues/71
 image_filename_stars = 'stars_logo.png'
@@ -26,8 +48,10 @@ encoded_image_plotly = base64.b64encode(open(image_filename_plotly, 'rb').read()
 
 # For the more recent version of Dash with Tabs: pip install dash-core-components==0.24.0-rc2
 # It was here https://github.com/plotly/dash-core-components/pull/213 andhttps://github.com/plotly/dash-core-components/pull/74
+# The clientside callbacks need Dash >= 0.41 and the checklists use the 'values' prop of dash-core-components < 1.0, so requirements.txt pins
+# dash 0.43.0 (dash-core-components 0.48.0, dash-renderer 0.24.0)
 
-app = dash.Dash()
+app = dash.Dash(__name__) # __name__ so the assets folder (browser-side callbacks) is found next to app.py under gunicorn too
 server = app.server
 app.config['suppress_callback_exceptions']=True # If you have an id in the layout/callbacks that is not in the callbacks/layout
 
@@ -38,74 +62,1611 @@ app.css.append_css({'external_url': 'https://codepen.io/amyoshino/pen/jzXypZ.css
 # Reading and Processing Data #
 
 #### TIDY DATASET ###
-csv_path = ps.examples.get_path('usjoin.csv')
-usjoin = pd.read_csv(csv_path)
-
-years = list(range(1929, 2010))                  
-cols_to_calculate = list(map(str, years))
-
-shp_path = ps.examples.get_path('us48.shp')
-us48_map = gpd.read_file(shp_path)
-us48_map = us48_map[['STATE_FIPS','STATE_ABBR','geometry']]
-us48_map.STATE_FIPS = us48_map.STATE_FIPS.astype(int)
-df_map = us48_map.merge(usjoin, on='STATE_FIPS')
-
-# Making the dataset tidy
-us_tidy = pd.melt(df_map, 
-                  id_vars=['Name', 'STATE_FIPS', 'STATE_ABBR', 'geometry'],
-                  value_vars=cols_to_calculate, 
-                  var_name='Year', 
-                  value_name='Income').sort_values('Name')
-
 # Function that calculates Per Capita Ratio
 def calculate_pcr(x):
     return x / np.mean(x)
 
-# Establishing a contiguity matrix for a specific year. It is the same for all years.
-W = Queen.from_dataframe(us_tidy[us_tidy.Year == '1929'])
-W.transform = 'r'
-
-# Function that calculates lagged value
-def calculate_lag_value(x):
-    return ps.lag_spatial(W, x)
-
 # Function that calculates rank
 def calculate_rank(x):
     return rankdata(x, method = 'ordinal')
 
-# In the first function (calculate_pcr), a series is returned, in the second (calculate_lag_value), an array, so the assign method is used to keep the indexes of the pandas Dataframe
-
-us_tidy['PCR'] = us_tidy.groupby('Year').Income.apply(lambda x: calculate_pcr(x))
-us_tidy = us_tidy.assign(Rank = us_tidy.groupby('Year').Income.transform(calculate_rank),
-                         Income_Lagged = us_tidy.groupby('Year').Income.transform(calculate_lag_value),
-                         PCR_Lagged = us_tidy.groupby('Year').PCR.transform(calculate_lag_value))
+# Function that builds the region-indexed geometry store: the exterior ring of every part (NaN-free coordinates, with offsets),
+# the ring of the biggest part of each region (what return_biggest used to compute), the centroid of that part and the centroid of the whole region
+def build_geometry_store(geometries):
+    ring_xy = []
+    ring_offsets = [0]
+    region_rings = [0]
+    biggest_ring = []
+    part_centroid = []
+    centroid = []
+    for geom in geometries:
+        parts = list(getattr(geom, 'geoms', [geom])) # A Polygon has no parts, a MultiPolygon has several
+        areas = [p.area for p in parts]
+        biggest = parts[areas.index(max(areas))]
+        biggest_ring.append(len(ring_offsets) - 1 + areas.index(max(areas)))
+        for p in parts:
+            xy = np.asarray(p.exterior.coords)[:, :2]
+            ring_xy.append(xy)
+            ring_offsets.append(ring_offsets[-1] + len(xy))
+        region_rings.append(len(ring_offsets) - 1)
+        part_centroid.append([biggest.centroid.x, biggest.centroid.y])
+        centroid.append([geom.centroid.x, geom.centroid.y])
+    return {'geom_ring_xy': np.concatenate(ring_xy),
+            'geom_ring_offsets': np.array(ring_offsets),
+            'geom_region_rings': np.array(region_rings),
+            'geom_biggest_ring': np.array(biggest_ring),
+            'geom_part_centroid': np.array(part_centroid),
+            'geom_centroid': np.array(centroid)}
+
+# Function that reads a wide panel csv (one row per region, one column per year) in chunks, keeping only the id columns and a float array of the
+# years, so the memory used is about the size of the values and not of the text
+def read_panel_csv(csv_path, chunksize = 50000):
+    header = pd.read_csv(csv_path, nrows = 0).columns
+    year_columns = [c for c in header if str(c).strip().isdigit()]
+    id_columns = [c for c in header if c not in year_columns]
+    
+    ids, values = [], []
+    for chunk in pd.read_csv(csv_path, chunksize = chunksize, dtype = {c: str for c in id_columns}):
+        ids.append(chunk[id_columns])
+        values.append(chunk[year_columns].to_numpy(dtype = float))
+    return pd.concat(ids, ignore_index = True), np.vstack(values), [int(c) for c in year_columns]
+
+# Function that reads the regions from a shapefile, a zipped shapefile or a GeoJSON
+def read_geometry(path):
+    if path.lower().endswith('.zip'): return gpd.read_file('zip://' + os.path.abspath(path))
+    return gpd.read_file(path)
+
+# Function that makes join keys comparable: stripped strings, or integers when every key is a number (so '01' and '1' match)
+def normalize_keys(keys):
+    keys = keys.astype(str).str.strip()
+    if keys.str.fullmatch(r'\d+').all(): return keys.astype(int)
+    return keys
+
+# Function that returns the column joining the csv to the geometry: a column of both with unique values (STATE_FIPS for the US states)
+def join_key(ids, geo):
+    common = [c for c in ids.columns if c in geo.columns and c != 'geometry']
+    unique = [c for c in common if normalize_keys(ids[c]).is_unique and normalize_keys(geo[c]).is_unique]
+    if len(unique) == 0: raise ValueError('The csv and the geometry have no common column with unique values to join them')
+    return unique[0]
+
+# Function that reads the csv and the geometry and builds all the derived data of the app.
+# The cubes are dense (n_regions x n_years) arrays: rows are the region ids (regions sorted by Name, the same order used by W)
+# and columns follow the years, so the callbacks only index rows and columns instead of pivoting a tidy table on every interaction.
+def build_dataset(csv_path, shp_path):
+    ids, values, years = read_panel_csv(csv_path)
+    geo = read_geometry(shp_path)
+    
+    key = join_key(ids, geo)
+    ids = ids.assign(**{key: normalize_keys(ids[key]), 'row': np.arange(len(ids))})
+    geo = geo.assign(**{key: normalize_keys(geo[key])})
+    geo = geo[[key, 'geometry'] + [c for c in ['STATE_ABBR', 'NAME', 'name', 'STATE_NAME'] if c in geo.columns and c not in ids.columns]]
+    df_map = geo.merge(ids, on = key)
+    if 'Name' not in df_map.columns:
+        df_map['Name'] = df_map[[c for c in ['NAME', 'name', 'STATE_NAME', key] if c in df_map.columns][0]].astype(str)
+    df_map = df_map.sort_values('Name').reset_index(drop = True)
+    
+    # The transform of every year is applied to its column (the lagged values come from the spatial lag engine below)
+    income = values[df_map.row.values]
+    cubes = {'Income': income,
+             'PCR': np.column_stack([calculate_pcr(income[:, j]) for j in range(len(years))]),
+             'Rank': np.column_stack([calculate_rank(income[:, j]) for j in range(len(years))])}
+    # Inverse of the ranks, (n_years x n_regions): rank_to_region[year, rank - 1] is the region holding that rank (the ranks are ordinal)
+    cubes['rank_to_region'] = np.argsort(cubes['Rank'], axis = 0).T.copy()
+    
+    regions = df_map[['Name'] + [c for c in ['STATE_ABBR'] if c in df_map.columns] + [key]]
+    
+    # Establishing a contiguity matrix (CSR of the binary weights). It is the same for all years.
+    w_indptr, w_indices = build_weights(list(df_map.geometry))
+    
+    # Simplified outlines are enough for drawing (W is built above from the full geometries)
+    minx, miny, maxx, maxy = df_map.total_bounds
+    tolerance = 1e-4 * math.hypot(maxx - minx, maxy - miny)
+    geometry = build_geometry_store([g.simplify(tolerance, preserve_topology = True) for g in df_map.geometry])
+    geometry['geom_centroid'] = build_geometry_store(df_map.geometry)['geom_centroid']
+    
+    return {'years': years,
+            'regions': regions,
+            'geometry': geometry,
+            'cubes': cubes,
+            'w_indptr': w_indptr,
+            'w_indices': w_indices}
 #### END OF TIDY DATASET ###
 
 
-first_year = int(min(us_tidy.Year))
-last_year = int(max(us_tidy.Year))
+#### DATA CACHE ###
+# The derived data is written once to a cache folder named after the hash of the source files (and CACHE_VERSION).
+# Workers memory-map the arrays at import time and only rebuild the dataset when the sources change.
+
+CACHE_VERSION = 5
+cache_root = os.environ.get('WEBSTARS_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache'))
+
+# Function that hashes the content of the source files (the shapefile together with its .shx/.dbf/.prj) and the weights options
+def sources_hash(paths):
+    h = hashlib.sha1(('webstars-cache-v' + str(CACHE_VERSION) + '|' + weights_spec + '|' + repr(weights_snap_tolerance)).encode())
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()[:16]
+
+# Function that lists the files of a geometry source: the parts of a shapefile, or the file itself (a zipped shapefile or a GeoJSON)
+def shapefile_parts(shp_path):
+    base, ext = os.path.splitext(shp_path)
+    if ext.lower() != '.shp': return [shp_path]
+    return [base + ext for ext in ['.shp', '.shx', '.dbf', '.prj'] if os.path.exists(base + ext)]
+
+# Function that writes a dataset to the cache. It is written to a temporary folder and renamed, so concurrent workers never read half a cache
+def write_dataset_cache(path, dataset):
+    tmp_path = tempfile.mkdtemp(prefix = '.build-', dir = os.path.dirname(path))
+    
+    for name, values in list(dataset['cubes'].items()) + list(dataset['geometry'].items()):
+        np.save(os.path.join(tmp_path, name + '.npy'), values)
+    
+    np.save(os.path.join(tmp_path, 'w_indptr.npy'), dataset['w_indptr'])
+    np.save(os.path.join(tmp_path, 'w_indices.npy'), dataset['w_indices'])
+    
+    dataset['regions'].to_csv(os.path.join(tmp_path, 'regions.csv'), index = False)
+    
+    with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'years': dataset['years'], 'cubes': sorted(dataset['cubes']), 'geometry': sorted(dataset['geometry'])}, f)
+    
+    try:
+        os.rename(tmp_path, path)
+    except OSError: # Another worker finished the same cache first
+        shutil.rmtree(tmp_path, ignore_errors = True)
+
+# Function that reads a dataset from the cache, with the cubes memory-mapped (read-only)
+def load_dataset_cache(path):
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    
+    regions = pd.read_csv(os.path.join(path, 'regions.csv'))
+    
+    indptr = np.load(os.path.join(path, 'w_indptr.npy'))
+    indices = np.load(os.path.join(path, 'w_indices.npy'))
+    
+    return {'key': os.path.basename(path),
+            'years': manifest['years'],
+            'regions': regions,
+            'geometry': {name: np.load(os.path.join(path, name + '.npy'), mmap_mode = 'r') for name in manifest['geometry']},
+            'cubes': {var: np.load(os.path.join(path, var + '.npy'), mmap_mode = 'r') for var in manifest['cubes']},
+            'neighbors': [indices[indptr[i]:indptr[i + 1]].tolist() for i in range(len(regions))]}
+
+def load_or_build_dataset(csv_path, shp_path):
+    path = os.path.join(cache_root, sources_hash([csv_path] + shapefile_parts(shp_path)))
+    if not os.path.exists(os.path.join(path, 'manifest.json')):
+        if not os.path.isdir(cache_root): os.makedirs(cache_root)
+        write_dataset_cache(path, build_dataset(csv_path, shp_path))
+    return load_dataset_cache(path)
+#### END OF DATA CACHE ###
+
+
+#### WEIGHTS BUILDER ###
+# Contiguity from shared vertices: the boundary vertices of all the regions (snapped to a grid of the tolerance when it is > 0) are grouped
+# by their coordinates with one sort, and the regions sharing a vertex (queen) or an edge (rook) are neighbors, so the cost grows with the number
+# of vertices and not with the pairs of polygons. KNN and distance band weights come from a KD-tree of the centroids. The builders return the CSR
+# (indptr, indices) of the binary matrix, cached in the cache folder under a hash of the geometry and the options (so a new csv reuses them).
+
+weights_spec = os.environ.get('WEBSTARS_WEIGHTS', 'queen')              # queen, rook, knn:<k> or band:<distance>
+weights_snap_tolerance = float(os.environ.get('WEBSTARS_SNAP_TOLERANCE', '0'))
+
+# Function that returns the vertices of the boundaries of the regions (every ring of every part) with the region and the ring of each vertex
+def boundary_vertices(geometries):
+    xy = []
+    region = []
+    ring = []
+    for i, geom in enumerate(geometries):
+        for part in getattr(geom, 'geoms', [geom]):
+            for boundary in [part.exterior] + list(part.interiors):
+                coords = np.asarray(boundary.coords)[:, :2]
+                xy.append(coords)
+                region.append(np.full(len(coords), i))
+                ring.append(np.full(len(coords), len(ring)))
+    return np.concatenate(xy), np.concatenate(region), np.concatenate(ring)
+
+# Function that numbers the distinct rows of an array (equal rows get the same id)
+def row_ids(keys):
+    order = np.lexsort(keys.T[::-1])
+    new = np.r_[True, (keys[order][1:] != keys[order][:-1]).any(axis = 1)]
+    ids = np.empty(len(keys), dtype = np.int64)
+    ids[order] = np.cumsum(new) - 1
+    return ids
+
+# Function that returns the CSR of the binary matrix with ones at (rows, cols), without the diagonal
+def pairs_csr(rows, cols, n):
+    keep = rows != cols
+    matrix = scipy.sparse.csr_matrix((np.ones(keep.sum()), (rows[keep], cols[keep])), shape = (n, n))
+    matrix.sum_duplicates()
+    return matrix.indptr, matrix.indices
+
+# Function that returns the CSR of the regions sharing a key (a vertex or an edge): every region of a key against every region of the same key
+def shared_key_csr(key, region, n):
+    pairs = np.unique(np.column_stack([key, region]), axis = 0)             # each region once per key, sorted by key
+    key, region = pairs[:, 0], pairs[:, 1]
+    starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+    sizes = np.diff(np.r_[starts, len(key)])
+    starts, sizes = starts[sizes > 1], sizes[sizes > 1]                     # a key of a single region makes no neighbors
+    
+    member = np.repeat(starts, sizes) + np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    member_start = np.repeat(starts, sizes)
+    member_size = np.repeat(sizes, sizes)
+    offsets = np.arange(member_size.sum()) - np.repeat(np.cumsum(member_size) - member_size, member_size)
+    return pairs_csr(np.repeat(region[member], member_size), region[np.repeat(member_start, member_size) + offsets], n)
+
+# Function that returns the queen (shared vertex) or rook (shared edge) contiguity of some polygons, as libpysal.weights.Queen / Rook
+def contiguity_csr(geometries, rook = False, tolerance = 0.0):
+    xy, region, ring = boundary_vertices(geometries)
+    if tolerance > 0: xy = np.round(xy / tolerance)
+    vertex = row_ids(xy)
+    if not rook: return shared_key_csr(vertex, region, len(geometries))
+    
+    edge = np.flatnonzero(ring[1:] == ring[:-1])                            # consecutive vertices of the same ring
+    ends = np.sort(np.column_stack([vertex[edge], vertex[edge + 1]]), axis = 1)
+    return shared_key_csr(row_ids(ends), region[edge], len(geometries))
+
+# Function that returns the k nearest neighbors of every point (a coincident point other than itself can be one of them)
+def knn_csr(points, k):
+    distances, ids = scipy.spatial.cKDTree(points).query(points, k = k + 1)
+    is_self = ids == np.arange(len(points))[:, None]
+    is_self[~is_self.any(axis = 1), -1] = True
+    indices = np.sort(ids[~is_self].reshape(len(points), k), axis = 1)
+    return np.arange(0, len(points) * k + 1, k), indices.ravel()
+
+# Function that returns the points within a distance of every point
+def distance_band_csr(points, threshold):
+    pairs = scipy.spatial.cKDTree(points).query_pairs(threshold, output_type = 'ndarray')
+    return pairs_csr(np.r_[pairs[:, 0], pairs[:, 1]], np.r_[pairs[:, 1], pairs[:, 0]], len(points))
+
+# Function that returns the CSR of the weights of some geometries (WEBSTARS_WEIGHTS), from the cache folder when they were built before
+def build_weights(geometries, spec = None, tolerance = None):
+    if spec is None: spec = weights_spec
+    if tolerance is None: tolerance = weights_snap_tolerance
+    h = hashlib.sha1(('webstars-weights-v' + str(CACHE_VERSION) + '|' + spec + '|' + repr(tolerance)).encode())
+    for geom in geometries:
+        h.update(geom.wkb)
+    path = os.path.join(cache_root, 'weights-' + h.hexdigest()[:16] + '.npz')
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            return cached['indptr'], cached['indices']
+    
+    kind, _, value = spec.partition(':')
+    centroids = np.array([[geom.centroid.x, geom.centroid.y] for geom in geometries])
+    if kind in ['queen', 'rook']: indptr, indices = contiguity_csr(geometries, kind == 'rook', tolerance)
+    elif kind == 'knn': indptr, indices = knn_csr(centroids, int(value))
+    elif kind == 'band': indptr, indices = distance_band_csr(centroids, float(value))
+    else: raise ValueError('Unknown weights: ' + spec)
+    
+    if not os.path.isdir(cache_root): os.makedirs(cache_root)
+    tmp_path = path + '.tmp-' + str(os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, indptr = indptr, indices = indices)
+    os.replace(tmp_path, path)
+    return indptr, indices
+#### END OF WEIGHTS BUILDER ###
+
+
+#### JOB QUEUE ###
+# Long computations (the builds of the uploads and the LIMA permutations) run as jobs in a process pool, never in the thread serving a request.
+# A job can also be split into tasks run in parallel by the pool (the blocks of permutations of a LIMA run), the worker submitting it combining their results.
+# The jobs are rows of a SQLite table in the cache folder, shared by all the workers: the id of a job is a hash of what it computes, so the
+# same job submitted again (by any worker) while it is queued or running is not run twice, and a finished job is a stored result. A job
+# reports its progress to its row and the callbacks poll the row, drawing a placeholder until the result is there.
+
+job_workers = int(os.environ.get('WEBSTARS_JOB_WORKERS', '2'))
+job_timeout = 600                # seconds without progress after which a running job is given up and can be submitted again
+job_store_size = 1000
+job_store_path = os.path.join(cache_root, 'jobs.sqlite')
+job_store_local = threading.local()
+job_pool = None
+job_pool_lock = threading.Lock()
+
+# Function that returns the SQLite connection of the current thread (opened again after a fork)
+def job_store():
+    if getattr(job_store_local, 'pid', None) != os.getpid():
+        connection = sqlite3.connect(job_store_path, timeout = 5, isolation_level = None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, kind TEXT, status TEXT, progress REAL, message TEXT, result BLOB, pid INTEGER, updated REAL)')
+        job_store_local.connection, job_store_local.pid = connection, os.getpid()
+    return job_store_local.connection
+
+# Function that returns the process pool of the jobs. Its processes are never forked from a web worker, whose other threads may hold the
+# locks of the registry and the caches: a forkserver, started clean and having imported this module once, forks them (spawn where it is missing)
+def job_process_pool():
+    global job_pool
+    with job_pool_lock:
+        if job_pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            context = multiprocessing.get_context(method)
+            if method == 'forkserver': context.set_forkserver_preload([__name__])
+            job_pool = concurrent.futures.ProcessPoolExecutor(max_workers = job_workers, mp_context = context, initializer = job_process_init)
+    return job_pool
+
+# Function run by each process of the pool when it starts: the shared segments of the datasets it holds (the build of an upload, for instance)
+# are released when it exits
+def job_process_init():
+    multiprocessing.util.Finalize(None, release_dataset_segments, exitpriority = 10)
+
+def release_dataset_segments():
+    with dataset_registry_lock:
+        keys = list(dataset_registry)
+    for key in keys:
+        release_shared_segment(key)
+
+def job_id(kind, *args):
+    return hashlib.sha1(json.dumps([kind] + list(args)).encode()).hexdigest()[:16]
+
+# Function that returns the row of a job as a dict (None if it was never submitted)
+def job_status(job):
+    row = job_store().execute('SELECT status, progress, message, result, pid, updated FROM jobs WHERE id = ?', (job,)).fetchone()
+    if row is None: return None
+    status, progress, message, result, pid, updated = row
+    return {'status': status, 'progress': progress, 'message': message, 'pid': pid, 'updated': updated,
+            'result': pickle.loads(result) if status == 'done' else None}
+
+# Function that tells if a process of this machine is alive
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+# Function that tells if a queued or running job will still finish: its process is alive and it reported recently
+def job_pending(row):
+    if row is None or row['status'] not in ('queued', 'running'): return False
+    return process_alive(row['pid']) and time.time() - row['updated'] < job_timeout
+
+def update_job(job, **fields):
+    fields['updated'] = time.time()
+    job_store().execute('UPDATE jobs SET {} WHERE id = ?'.format(', '.join(name + ' = ?' for name in fields)), list(fields.values()) + [job])
+
+# Function that runs a job in the pool. function(progress, *args) reports its progress with progress(fraction, message)
+def run_job(job, function, *args):
+    update_job(job, status = 'running', pid = os.getpid())
+    try:
+        result = function(lambda fraction, message = '': update_job(job, progress = fraction, message = message), *args)
+    except Exception as e:
+        update_job(job, status = 'failed', message = '{}: {}'.format(type(e).__name__, e))
+        return
+    update_job(job, status = 'done', progress = 1.0, result = sqlite3.Binary(pickle.dumps(result, protocol = pickle.HIGHEST_PROTOCOL)))
+
+# Function that queues the row of a job unless it is done or pending. It returns True when this call queued it
+def claim_job(job, kind):
+    store = job_store()
+    store.execute('BEGIN IMMEDIATE')
+    try:
+        row = job_status(job)
+        if row is not None and (row['status'] == 'done' or job_pending(row)):
+            store.execute('COMMIT')
+            return False
+        store.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (job, kind, 'queued', 0.0, '', None, os.getpid(), time.time()))
+        store.execute("DELETE FROM jobs WHERE id IN (SELECT id FROM jobs WHERE status IN ('done', 'failed') ORDER BY updated DESC LIMIT -1 OFFSET ?)", (job_store_size,))
+        store.execute('COMMIT')
+    except BaseException:
+        store.execute('ROLLBACK')
+        raise
+    return True
+
+# Function that runs function(*args) in the pool and returns its future
+def pool_submit(function, *args):
+    global job_pool
+    try:
+        return job_process_pool().submit(function, *args)
+    except concurrent.futures.BrokenExecutor:
+        # A process of the pool died (killed for its memory, for instance), the pool is started again
+        with job_pool_lock:
+            job_pool = None
+        return job_process_pool().submit(function, *args)
+
+# Function that submits a job unless it is done or pending. It returns True when this call submitted it
+def submit_job(job, kind, function, *args):
+    if not claim_job(job, kind): return False
+    pool_submit(run_job, job, function, *args)
+    return True
+
+# Function that submits a job split into tasks run in parallel by the pool: tasks is a list of (function, args) and combine(results), called
+# in this process once every task is done, returns the result of the job. The progress of the job is the share of its tasks done
+def submit_split_job(job, kind, tasks, combine):
+    if not claim_job(job, kind): return False
+    update_job(job, status = 'running')
+    results = [None] * len(tasks)
+    remaining = [len(tasks)]
+    lock = threading.Lock()
+    
+    def task_done(i, future):
+        with lock:
+            if remaining[0] == 0: return    # a task already failed the job
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                remaining[0] = 0
+                update_job(job, status = 'failed', message = '{}: {}'.format(type(e).__name__, e))
+                return
+            remaining[0] -= 1
+            update_job(job, progress = 1.0 - remaining[0] / len(tasks))
+            if remaining[0] > 0: return
+        try:
+            result = combine(results)
+        except Exception as e:
+            update_job(job, status = 'failed', message = '{}: {}'.format(type(e).__name__, e))
+            return
+        update_job(job, status = 'done', progress = 1.0, result = sqlite3.Binary(pickle.dumps(result, protocol = pickle.HIGHEST_PROTOCOL)))
+    
+    for i, (function, args) in enumerate(tasks):
+        pool_submit(function, *args).add_done_callback(functools.partial(task_done, i))
+    return True
+#### END OF JOB QUEUE ###
+
+
+#### UPLOAD PIPELINE ###
+# The uploaded csv and geometry are decoded to disk slice by slice (never holding a second, decoded copy of the payload) into a staging folder,
+# and the dataset is built from the staged files by a job, so the callback returns as soon as the files are written.
+# An uploaded dataset goes through the same cache as the default one: once its cache folder is written, its cache key is a dataset id of
+# the registry below and the browser keeps it in the session-scoped dataset-id store.
+
+upload_root = os.path.join(cache_root, 'uploads')
+
+# Function that writes the base64 payload of a dcc.Upload to a file, decoding a few MB at a time (the slices are multiples of 4 characters)
+def write_upload(contents, path, chunk_size = 4 << 20):
+    start = contents.index(',') + 1
+    with open(path, 'wb') as f:
+        for i in range(start, len(contents), chunk_size):
+            f.write(base64.b64decode(contents[i:i + chunk_size]))
+
+# Function run as a job: writes the cache of an uploaded dataset (the staged files are removed once it is written), then builds its registry
+# entry, so the results the entry writes in the cache folder (Moran, LISA, Spatial Markov and the LIMA store) are computed in the job and only
+# read by the web workers
+def ingest_dataset(progress, staging, csv_file, geometry_file):
+    try:
+        progress(0.1, 'Reading the files and building the weights')
+        key = load_or_build_dataset(csv_file, geometry_file)['key']
+    finally:
+        shutil.rmtree(staging, ignore_errors = True)
+    progress(0.6, 'Precomputing the statistics')
+    entry = dataset_entry(key)
+    return {'key': key, 'n_regions': entry['n_regions'], 'first_year': entry['years'][0], 'last_year': entry['years'][-1]}
+
+def dataset_ready(dataset_id):
+    return os.path.exists(os.path.join(cache_root, dataset_id, 'manifest.json'))
+
+# Function that stages an upload and submits its build. Uploads of the same files get the same id (also the id of the job), and reuse the running build
+def submit_upload(csv_contents, csv_filename, geometry_contents, geometry_filename):
+    if not os.path.isdir(upload_root): os.makedirs(upload_root)
+    staging = tempfile.mkdtemp(dir = upload_root)
+    
+    csv_file = os.path.join(staging, 'data.csv')
+    geometry_file = os.path.join(staging, 'geometry' + os.path.splitext(geometry_filename)[1].lower())
+    write_upload(csv_contents, csv_file)
+    write_upload(geometry_contents, geometry_file)
+    
+    dataset_id = sources_hash([csv_file, geometry_file])
+    if not submit_job(dataset_id, 'dataset', ingest_dataset, staging, csv_file, geometry_file):
+        shutil.rmtree(staging, ignore_errors = True)
+    return dataset_id
+
+# Function that describes the state of an uploaded dataset for the upload-status message (from the job table, so any worker can answer)
+def upload_status(dataset_id):
+    job = job_status(dataset_id)
+    if job is not None and job['status'] == 'done':
+        return 'Dataset ready: {} regions, years {}-{}'.format(job['result']['n_regions'], job['result']['first_year'], job['result']['last_year'])
+    if job_pending(job): return 'Building the dataset ({:.0%}): {}...'.format(job['progress'], job['message'] or 'queued')
+    if job is not None and job['status'] == 'failed': return 'The dataset could not be built: {}'.format(job['message'])
+    if dataset_ready(dataset_id): return 'Dataset ready'
+    return 'Dataset not found, please upload the files again'
+
+# Function that tells if the upload-status message must be polled again
+def upload_pending(dataset_id):
+    return job_pending(job_status(dataset_id))
+#### END OF UPLOAD PIPELINE ###
+
+
+#### DATASET REGISTRY ###
+# Every dataset (the bundled US states and the uploads) gets an entry with its arrays, weights, region index, years and the caches of the
+# engines, built on first access and kept in an LRU bounded by a memory budget. Callbacks take the dataset-id store as their first input and
+# run with its entry as the active dataset of the thread, so the engines below read the arrays and weights of the dataset being shown.
+
+dataset_registry = collections.OrderedDict()
+dataset_registry_lock = threading.RLock()
+dataset_memory_budget = int(os.environ.get('WEBSTARS_DATASET_MEMORY_MB', '1024')) << 20
+dataset_local = threading.local()
+dataset_builds = {}           # dataset id -> threading.Event set when the thread building its entry is done
+dataset_warmers = []          # functions run with a new entry active, each engine adds the results it precomputes
+
+# Function that returns the dataset of the running callback (the default dataset outside of the callbacks)
+def active_dataset():
+    entry = getattr(dataset_local, 'entry', None)
+    if entry is None: return dataset_entry(default_dataset_id)
+    return entry
+
+# Function that returns a cache of the active dataset (evicted together with its entry)
+def dataset_cache(name):
+    return active_dataset()['caches'][name]
+
+# Function that calls a function with a dataset as the active dataset of the thread
+def with_dataset(entry, function, *args):
+    previous = getattr(dataset_local, 'entry', None)
+    dataset_local.entry = entry
+    try:
+        return function(*args)
+    finally:
+        dataset_local.entry = previous
+
+# Decorator of the callbacks whose first input is the dataset-id store
+def dataset_callback(function):
+    @functools.wraps(function)
+    def wrapper(dataset_id, *args):
+        return with_dataset(dataset_entry(dataset_id), function, *args)
+    return wrapper
+
+# Function that estimates the memory held by the arrays of an entry (python lists of numbers are counted at 32 bytes per item)
+def nested_nbytes(value):
+    if isinstance(value, np.ndarray): return value.nbytes
+    if isinstance(value, dict): return sum(nested_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        if any(isinstance(v, (np.ndarray, dict, list, tuple)) for v in value[:2]): return sum(nested_nbytes(v) for v in value)
+        return 32 * len(value)
+    return 0
 
-years = list(range(first_year, last_year+1))                  
-years_aux = [str(i) for i in years] # Converting each element to string (it could be list(map(str, years)))
-years_options = [{'label': i, 'value': i} for i in years_aux]
+# Function that estimates the memory of an entry: its arrays (mapped from its shared segment, so the segment is counted in full) and its caches
+def dataset_nbytes(entry):
+    return nested_nbytes(entry['arrays']) + nested_nbytes(entry['caches'])
+
+# Function that returns the id of a dataset in the cache folder (e.g. an upload that finished building), otherwise the id of the default dataset
+def resolve_dataset_id(dataset_id):
+    if isinstance(dataset_id, str) and re.match(r'^[0-9a-f]{16}$', dataset_id) and os.path.exists(os.path.join(cache_root, dataset_id, 'manifest.json')):
+        return dataset_id
+    return default_dataset_id
+
+# Function that builds the entry of a dataset read from the cache and precomputes its engine results
+def build_dataset_entry(dataset):
+    regions = dataset['regions']
+    
+    # The weights are rebuilt from the cached neighbors, with ids following the regions order
+    w = libpysal.weights.W({i: nb for i, nb in enumerate(dataset['neighbors'])})
+    w.transform = 'r'
+    # The rank statistics (LIMA) work on the binary neighbor structure, so they get their own copy and W stays row-standardized
+    w_binary = copy.deepcopy(w)
+    w_binary.transform = 'b'
+    
+    index = region_index(regions)
+    entry = {'key': dataset['key'],
+             'regions': regions,
+             'n_regions': len(regions),
+             'us_states': 'STATE_ABBR' in regions.columns and regions['STATE_ABBR'].is_unique,
+             'years': list(dataset['years']),
+             'year_to_col': {year: j for j, year in enumerate(dataset['years'])},
+             'arrays': attach_shared_segment(dataset['key'], dataset_segment(dataset, w)),
+             'W': w,
+             'W_binary': w_binary,
+             'region_index': index,
+             'default_region': index.get('California', 0),
+             'caches': collections.defaultdict(dict)}
+    
+    # The lags of W are already in the shared segment
+    for var in ['Income', 'PCR']:
+        entry['caches']['lag'][(var, id(w), w.transform)] = (w, entry['arrays'][var + '_Lagged'])
+    
+    for warm in dataset_warmers:
+        with_dataset(entry, warm)
+    return entry
+
+# Function that returns results of an engine for the weights of the active dataset, stored in its cache folder under a hash of their description
+# (engine and parameters): the first build of the entry computes and writes them (the job building an upload, or the startup for the default
+# dataset) and the web workers only read them
+def stored_results(description, compute):
+    h = hashlib.sha1(repr(description).encode())
+    path = os.path.join(cache_root, active_dataset()['key'], 'results-' + h.hexdigest()[:16] + '.pkl')
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    results = compute()
+    tmp_path = path + '.tmp-' + str(os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(results, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    return results
+
+# Function that returns the entry of a dataset, building it on first access and evicting the least recently used entries over the memory budget.
+# The entry is built outside of the registry lock, so a build only holds the requests of its own dataset: they wait for the thread building it
+def dataset_entry(dataset_id):
+    dataset_id = resolve_dataset_id(dataset_id)
+    while True:
+        with dataset_registry_lock:
+            if dataset_id in dataset_registry:
+                dataset_registry.move_to_end(dataset_id)
+                return dataset_registry[dataset_id]
+            build = dataset_builds.get(dataset_id)
+            leader = build is None
+            if leader: build = dataset_builds[dataset_id] = threading.Event()
+        if leader: break
+        build.wait()
+        # The entry is registered now, unless the build failed (then this thread builds it)
+    
+    evicted = []
+    try:
+        entry = build_dataset_entry(load_dataset_cache(os.path.join(cache_root, dataset_id)))
+        with dataset_registry_lock:
+            dataset_registry[dataset_id] = entry
+            while len(dataset_registry) > 1 and sum(dataset_nbytes(e) for e in dataset_registry.values()) > dataset_memory_budget:
+                evicted.append(dataset_registry.popitem(last = False)[0])
+    finally:
+        with dataset_registry_lock:
+            del dataset_builds[dataset_id]
+        build.set()
+    for key in evicted:
+        release_shared_segment(key)
+    return entry
+#### END OF DATASET REGISTRY ###
+
+
+#### REGION REGISTRY ###
+# Hash index from name, abbreviation and FIPS code (or the id column of an upload) to the row id of a region. The map and scatter points carry
+# the row id in customdata, so clicks and selections are resolved without matching display names (a name that repeats, e.g. in counties, keeps its first region).
+
+def region_index(regions):
+    index = {}
+    for key_column in regions.columns:
+        for i, key in enumerate(regions[key_column]):
+            index.setdefault(key, i)
+            index.setdefault(str(key), i)
+    return index
+
+# Function that returns the row id of a clicked, hovered or selected point (its customdata, or its text for traces without customdata).
+# A point of another dataset (the payload of a graph before it is redrawn) gives the default region.
+def point_region(point):
+    entry = active_dataset()
+    if point.get('customdata') is not None: region = int(point['customdata'])
+    else: region = entry['region_index'].get(point.get('text'), entry['default_region'])
+    return region if region < entry['n_regions'] else entry['default_region']
+#### END OF REGION REGISTRY ###
+
+
+#### SHARED ARRAYS ###
+# The numeric arrays (cubes, lags, weights and the geometry store) live in a segment created once per dataset (by the gunicorn master when started with --preload, otherwise by
+# the first worker) in /dev/shm, and every worker maps it read-only, so memory does not grow with the number of workers.
+# Callbacks look the arrays of the active dataset up by name with get_array.
+# Every process attaching a segment leaves its pid in the users/ folder of the segment, and removes it when the registry evicts the dataset: the
+# last user removes the segment (the processes that still map it keep reading it until they unmap it). Users that died without releasing
+# it are not counted.
+
+shm_root = os.environ.get('WEBSTARS_SHM_DIR', '/dev/shm' if os.path.isdir('/dev/shm') else cache_root)
+
+# Context manager holding the lock file of a segment, so creating, attaching and removing it are not interleaved between processes
+@contextlib.contextmanager
+def segment_lock(path):
+    if fcntl is None:
+        yield
+        return
+    with open(path + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+# Function that creates the shared segment (if it does not exist yet) and returns all of its arrays attached read-only
+def attach_shared_segment(name, arrays):
+    path = os.path.join(shm_root, 'webstars-' + name)
+    with segment_lock(path):
+        if not os.path.exists(os.path.join(path, 'ready')):
+            tmp_path = tempfile.mkdtemp(prefix = '.segment-', dir = shm_root)
+            for key, values in arrays.items():
+                np.save(os.path.join(tmp_path, key + '.npy'), values)
+            open(os.path.join(tmp_path, 'ready'), 'w').close()
+            try:
+                os.rename(tmp_path, path)
+            except OSError: # Another process created the segment first
+                shutil.rmtree(tmp_path, ignore_errors = True)
+        if not os.path.isdir(os.path.join(path, 'users')): os.makedirs(os.path.join(path, 'users'))
+        open(os.path.join(path, 'users', str(os.getpid())), 'w').close()
+        return {file_name[:-4]: np.load(os.path.join(path, file_name), mmap_mode = 'r') for file_name in os.listdir(path) if file_name.endswith('.npy')}
+
+# Function that detaches the current process from the shared segment of a dataset, removing the segment if no live process uses it
+def release_shared_segment(name):
+    path = os.path.join(shm_root, 'webstars-' + name)
+    with segment_lock(path):
+        users = os.path.join(path, 'users')
+        if not os.path.isdir(users): return
+        try:
+            os.remove(os.path.join(users, str(os.getpid())))
+        except OSError:
+            pass
+        if not any(process_alive(int(pid)) for pid in os.listdir(users)):
+            shutil.rmtree(path, ignore_errors = True)
+
+# Function that returns the arrays of the segment of a dataset: its cubes, the geometry store, the lags and the weights
+def dataset_segment(dataset, w):
+    w_sparse = w.sparse.tocsr()
+    segment = dict(dataset['cubes'])
+    segment.update(dataset['geometry'])
+    segment.update({'Income_Lagged': w_sparse.dot(segment['Income']),
+                    'PCR_Lagged': w_sparse.dot(segment['PCR']),
+                    'w_indptr': w_sparse.indptr,
+                    'w_indices': w_sparse.indices,
+                    'w_data': w_sparse.data})
+    return segment
+
+def get_array(name):
+    return active_dataset()['arrays'][name]
+#### END OF SHARED ARRAYS ###
+
+
+#### GEOMETRY TRACES ###
+# The outline (biggest part) and centroid of every region are converted to lists once per dataset. The map of the datasets that are not US states,
+# the RankPath and the LIMA callbacks join them into a single trace per layer, with None between regions, and only change colors, hover text and overlays.
+
+# Function that returns the outline of the biggest part of a region and the centroid of that part, from the geometry store
+def region_outline(i):
+    offsets = get_array('geom_ring_offsets')
+    ring = get_array('geom_biggest_ring')[i]
+    xy = get_array('geom_ring_xy')[offsets[ring]:offsets[ring + 1]]
+    c_xy = get_array('geom_part_centroid')[i]
+    return xy[:, 0].tolist(), xy[:, 1].tolist(), [c_xy[0]], [c_xy[1]]
+
+def geometry_traces():
+    templates = dataset_cache('geometry_traces')
+    if 'outlines' not in templates:
+        outlines = [region_outline(i) for i in range(active_dataset()['n_regions'])]
+        templates.update({'outlines': [(x + [None], y + [None]) for x, y, c_x, c_y in outlines],
+                          'centroid_x': [c_x[0] for x, y, c_x, c_y in outlines],
+                          'centroid_y': [c_y[0] for x, y, c_x, c_y in outlines]})
+    return templates
+
+# Function that joins the outlines of some regions into the coordinates of a single trace
+def outline_xy(region_ids):
+    outlines = geometry_traces()['outlines']
+    x = []
+    y = []
+    for i in region_ids:
+        x += outlines[i][0]
+        y += outlines[i][1]
+    return x, y
+
+dataset_warmers.append(geometry_traces)
+#### END OF GEOMETRY TRACES ###
+
+
+# Function that returns the variable of the cubes chosen in the type_data_selector
+def cube_variable(type_data):
+    return 'Income' if type_data == 'raw' else 'PCR'
+
+
+#### SPATIAL LAG ENGINE ###
+# The lag of every year is a single sparse product W.sparse x (n_regions x n_years) instead of one ps.lag_spatial call per year.
+# Results are cached per variable and per weights object (and its transform, since it changes the lag), with the dataset.
+
+# Function that returns the lagged cube of a variable
+def lag_cube(var, w = None):
+    if w is None: w = active_dataset()['W']
+    lag_cache = dataset_cache('lag')
+    key = (var, id(w), w.transform)
+    if key not in lag_cache:
+        lag_cache[key] = (w, np.asarray(w.sparse.dot(get_array(var)))) # w is kept in the cache so its id is not reused by another object
+    return lag_cache[key][1]
+#### END OF SPATIAL LAG ENGINE ###
+
+#### MORAN ENGINE ###
+# Global Moran's I of every year at once: the cube is standardized column by column and one sparse product gives I for all the years.
+# The permutation nulls of all the years are drawn together, using the same permutation index arrays for every year. Cached with the dataset.
+
+# Function that returns I, expected I, z-scores, pseudo p-values and the permutation band of every year of a variable (the results of the
+# weights of the dataset are stored in its cache folder)
+def moran_series(var, w = None, permutations = 999, seed = 12345):
+    if w is None: w = active_dataset()['W']
+    moran_cache = dataset_cache('moran')
+    key = (var, id(w), w.transform, permutations)
+    if key not in moran_cache:
+        if w is active_dataset()['W']: moran = stored_results(['moran', var, w.transform, permutations, seed], lambda: moran_statistics(var, w, permutations, seed))
+        else: moran = moran_statistics(var, w, permutations, seed)
+        moran_cache[key] = (w, moran)
+    return moran_cache[key][1]
+
+def moran_statistics(var, w, permutations, seed):
+    z = np.asarray(get_array(var), dtype = float)
+    z = z - z.mean(axis = 0)
+    n, t = z.shape
+    sparse = w.sparse
+    factor = n / sparse.sum()                                        # n / S0
+    zz = (z ** 2).sum(axis = 0)
+    
+    moran = {'I': factor * (z * sparse.dot(z)).sum(axis = 0) / zz,
+             'EI': -1.0 / (n - 1)}
+    
+    if permutations > 0:
+        prng = np.random.RandomState(seed)
+        sim = np.zeros((permutations, t))
+        block = 100
+        for start in range(0, permutations, block):
+            size = min(block, permutations - start)
+            ids = prng.rand(size, n).argsort(axis = 1)                # size permutations of the regions, shared by all the years
+            zp = z[ids].transpose(1, 0, 2).reshape(n, size * t)       # (n, size * t)
+            sim[start:start + size] = factor * (zp * sparse.dot(zp)).sum(axis = 0).reshape(size, t) / zz
+        
+        larger = (sim >= moran['I']).sum(axis = 0)
+        larger = np.where(permutations - larger < larger, permutations - larger, larger)
+        moran['EI_sim'] = sim.mean(axis = 0)
+        moran['z_sim'] = (moran['I'] - moran['EI_sim']) / sim.std(axis = 0)
+        moran['p_sim'] = (larger + 1.0) / (permutations + 1.0)
+        moran['band_low'], moran['band_high'] = np.percentile(sim, [2.5, 97.5], axis = 0)
+    return moran
+
+def warm_moran():
+    for var in ['Income', 'PCR']: moran_series(var)
+
+dataset_warmers.append(warm_moran)
+#### END OF MORAN ENGINE ###
+
+
+#### LOCAL MORAN ENGINE ###
+# Local Moran's Ii (as esda.Moran_Local, row-standardized W) of every region and every year at once. The conditional permutations use the
+# same draws of the other regions for every region and every year (region i is skipped by shifting the drawn ids >= i), so each region is
+# one weighted sum over a (permutations x neighbors x years) block. The results are cached per variable and warmed with the dataset entry.
+
+lisa_labels = ['Not significant', 'High-High', 'Low-High', 'Low-Low', 'High-Low']   # cluster codes 0 to 4 (quadrants 1 to 4 when p < significance)
+
+# Function that returns Is, the quadrants, the pseudo p-values and the cluster codes of every region (rows) and year (columns) (the results of
+# the weights of the dataset are stored in its cache folder)
+def local_moran_series(var, w = None, permutations = 999, significance = 0.05, seed = 12345):
+    if w is None: w = active_dataset()['W']
+    lisa_cache = dataset_cache('lisa')
+    key = (var, id(w), w.transform, permutations, significance)
+    if key not in lisa_cache:
+        if w is active_dataset()['W']:
+            lisa = stored_results(['lisa', var, w.transform, permutations, significance, seed], lambda: local_moran_statistics(var, w, permutations, significance, seed))
+        else: lisa = local_moran_statistics(var, w, permutations, significance, seed)
+        lisa_cache[key] = (w, lisa)
+    return lisa_cache[key][1]
+
+def local_moran_statistics(var, w, permutations, significance, seed):
+    y = np.asarray(get_array(var), dtype = float)
+    z = (y - y.mean(axis = 0)) / y.std(axis = 0)
+    n, t = z.shape
+    sparse = w.sparse.tocsr()
+    lag = np.asarray(sparse.dot(z))
+    Is = (n - 1) * z * lag / n                                            # the sum of z ** 2 of a year is n
+    quadrant = np.where(z > 0, np.where(lag > 0, 1, 4), np.where(lag > 0, 2, 3))
+    lisa = {'Is': Is, 'q': quadrant}
+    
+    if permutations > 0:
+        prng = np.random.RandomState(seed)
+        card = np.diff(sparse.indptr)
+        draws = prng.rand(permutations, n - 1).argsort(axis = 1)[:, :card.max()]   # ids among the other n - 1 regions
+        larger = np.zeros((n, t), dtype = int)
+        for i in np.nonzero(card)[0]:
+            others = draws[:, :card[i]]
+            others = others + (others >= i)
+            weights = sparse.data[sparse.indptr[i]:sparse.indptr[i + 1]]
+            sim = (n - 1) * z[i] * np.einsum('pct,c->pt', z[others], weights) / n
+            larger[i] = (sim >= Is[i]).sum(axis = 0)
+        larger = np.where(permutations - larger < larger, permutations - larger, larger)
+        lisa['p_sim'] = (larger + 1.0) / (permutations + 1.0)
+        lisa['cluster'] = np.where(lisa['p_sim'] < significance, quadrant, 0)
+    return lisa
+
+def warm_local_moran():
+    for var in ['Income', 'PCR']: local_moran_series(var)
+
+if os.environ.get('WEBSTARS_WARM_LISA', '1') == '1': dataset_warmers.append(warm_local_moran)
+#### END OF LOCAL MORAN ENGINE ###
+
+
+#### MARKOV ENGINE ###
+# Spatial Markov (fixed quantile classes, as giddy.markov.Spatial_Markov(..., fixed = True)) for a whole grid of k and m in one pass.
+# The pooled values and their lags are sorted once and every k (or m) only reads its quantile cut-offs from the sorted arrays.
+# The transitions are counted with a single bincount over the encoded (lag class, from class, to class) triples.
+
+# Function that returns the quantile cut-offs of mapclassify.Quantiles (linear interpolation, repeated cut-offs collapsed) from sorted values
+def quantile_bins(sorted_values, k):
+    step = 100.0 / k
+    pct = np.arange(step, 100 + step, step)
+    pct[-1] = min(pct[-1], 100.0)
+    position = pct / 100.0 * (len(sorted_values) - 1)
+    lower = np.floor(position).astype(int)
+    upper = np.minimum(lower + 1, len(sorted_values) - 1)
+    return np.unique(sorted_values[lower] + (position - lower) * (sorted_values[upper] - sorted_values[lower]))
+
+# Function that calculates a mobility measure, which is not defined for some matrices (e.g. k = 1)
+def mobility_measure(p, measure):
+    try:
+        return mobility.markov_mobility(p, measure = measure)
+    except (IndexError, ValueError, ZeroDivisionError, np.linalg.LinAlgError):
+        return float('nan')
+
+# Function that returns {(k, m): {'p', 'P', 'T', mobility measures}} for every k in ks and m in ms
+def spatial_markov_grid(var, ks, ms, w = None, years_range = None):
+    if w is None: w = active_dataset()['W']
+    if years_range is None: years_range = (active_dataset()['years'][0], active_dataset()['years'][-1])
+    year_to_col = active_dataset()['year_to_col']
+    cols = slice(year_to_col[years_range[0]], year_to_col[years_range[1]] + 1)
+    
+    y = np.asarray(get_array(var)[:, cols], dtype = float)
+    ly = lag_cube(var, w)[:, cols]
+    sorted_y = np.sort(y.ravel())
+    sorted_ly = np.sort(ly.ravel())
+    
+    lag_classes = {}
+    for m in ms:
+        bins = quantile_bins(sorted_ly, m)
+        lag_classes[m] = (np.searchsorted(bins, ly[:, :-1]).ravel(), len(bins))   # the lag class of the origin year
+    
+    grid = {}
+    for k in ks:
+        bins = quantile_bins(sorted_y, k)
+        k_real = len(bins)
+        classes = np.searchsorted(bins, y)
+        transitions = classes[:, :-1].ravel() * k_real + classes[:, 1:].ravel()
+        
+        pooled = np.bincount(transitions, minlength = k_real * k_real).reshape(k_real, k_real).astype(float)
+        row_sum = pooled.sum(axis = 1, keepdims = True)
+        p = pooled / (row_sum + (row_sum == 0))
+        measures = {'shorrock_1': mobility_measure(p, "P"),
+                    'shorrock_2': mobility_measure(p, "D"),
+                    'som_con': mobility_measure(p, "L2")}
+        
+        for m in ms:
+            lag_class, m_real = lag_classes[m]
+            T = np.bincount(lag_class * k_real * k_real + transitions, minlength = m_real * k_real * k_real).reshape(m_real, k_real, k_real).astype(float)
+            row_sum = T.sum(axis = 2, keepdims = True)
+            markov = {'p': p, 'P': T / (row_sum + (row_sum == 0)), 'T': T}
+            markov.update(measures)
+            grid[(k, m)] = markov
+    return grid
+#### END OF MARKOV ENGINE ###
+
+
+#### MARKOV CACHE ###
+# The pooled and the spatial heatmaps fire on the same dropdowns, so the Spatial Markov results are memoized with the dataset (LRU with a size
+# bound, evicted together with its entry), keyed by variable, k, m, weights and year range. The whole dropdown space (k in 1..9, m in 3, 6, 9)
+# is warmed with each dataset in one call.
+
+markov_cache_size = 64        # per dataset, above the 27 results of the dropdowns
+markov_cache_lock = threading.Lock()
+
+def markov_cache_key(var, k, m, w, years_range):
+    return (var, k, m, id(w), w.transform, tuple(years_range))
+
+# Function that returns p, P and the mobility measures of the Spatial Markov of a variable
+def spatial_markov(var, k, m, w = None, years_range = None):
+    if w is None: w = active_dataset()['W']
+    if years_range is None: years_range = (active_dataset()['years'][0], active_dataset()['years'][-1])
+    key = markov_cache_key(var, k, m, w, years_range)
+    markov_cache = dataset_cache('markov')
+    with markov_cache_lock:
+        if key in markov_cache:
+            markov_cache[key] = markov_cache.pop(key)                 # most recently used last
+            return markov_cache[key][1]
+    
+    return store_markov_grid(var, spatial_markov_grid(var, [k], [m], w, years_range), w, years_range)[(k, m)]
+
+def store_markov_grid(var, grid, w, years_range):
+    markov_cache = dataset_cache('markov')
+    with markov_cache_lock:
+        for (k, m), markov in grid.items():
+            markov_cache[markov_cache_key(var, k, m, w, years_range)] = (w, markov)
+        while len(markov_cache) > markov_cache_size:
+            del markov_cache[next(iter(markov_cache))]
+    return grid
+
+# The grid of the dropdowns is stored in the cache folder of the dataset
+def warm_markov_cache():
+    years = active_dataset()['years']
+    grid = stored_results(['markov', 'PCR', list(range(1, 10)), [3, 6, 9]], lambda: spatial_markov_grid('PCR', range(1, 10), [3, 6, 9]))
+    store_markov_grid('PCR', grid, active_dataset()['W'], (years[0], years[-1]))
+
+if os.environ.get('WEBSTARS_WARM_MARKOV', '1') == '1': dataset_warmers.append(warm_markov_cache)
+#### END OF MARKOV CACHE ###
+
+
+#### LIMA ENGINE ###
+# Spatial Kendall's tau and the neighbor set LIMA (as giddy.rank.SpatialTau and Tau_Local_Neighbor) from the neighbor pairs of the weights CSR.
+# The observed statistics are a few array operations. The permutations are drawn in blocks, the tasks of the LIMA job run in parallel by the
+# job pool (the job reports its progress after each block). The blocks are seeded by their index, so the result does not depend on how they are run. The conditional permutations of the local taus use the same draws for every region (region i is skipped by shifting
+# the drawn ids >= i), so a block is one argsort whatever the number of regions.
+
+lima_permutations = int(os.environ.get('WEBSTARS_LIMA_PERMUTATIONS', '999'))    # default of the permutations dropdown of the Rank Methods tab
+lima_permutation_options = sorted(set([0, 99, 499, 999, 9999, lima_permutations]))
+lima_block = 250
+
+# Function that returns the spatial tau of each row of X and Y (permutations x regions) over the neighbor pairs (i, j) with i < j
+def spatial_tau_values(X, Y, i, j):
+    dx = X[:, i] - X[:, j]
+    dy = Y[:, i] - Y[:, j]
+    dxdy = dx * dy
+    tied = dxdy == 0
+    n1 = (~tied).sum(axis = 1) + (tied & (dx != 0)).sum(axis = 1)
+    n2 = (~tied).sum(axis = 1) + (tied & (dy != 0)).sum(axis = 1)
+    return np.sign(dxdy).sum(axis = 1) / (np.sqrt(n1) * np.sqrt(n2))
+
+# Function that runs one block of permutations: the simulated spatial taus and how many simulated local taus are >= and <= the observed ones
+def lima_permutation_block(x, y, indptr, indices, tau_ln, size, seed):
+    prng = np.random.RandomState(seed)
+    n = len(x)
+    card = np.diff(indptr)
+    rows = np.repeat(np.arange(n), card)
+    upper = rows < indices
+    
+    ids = prng.rand(size, n).argsort(axis = 1)
+    taus = spatial_tau_values(x[ids], y[ids], rows[upper], indices[upper])
+    
+    draws = prng.rand(size, n - 1).argsort(axis = 1)[:, :card.max()]   # ids among the other n - 1 regions
+    larger = np.zeros(n, dtype = int)
+    smaller = np.zeros(n, dtype = int)
+    for i in np.nonzero(card)[0]:
+        others = draws[:, :card[i]]
+        others = others + (others >= i)
+        sim = np.sign((x[i] - x[others]) * (y[i] - y[others])).mean(axis = 1)
+        larger[i] = (sim >= tau_ln[i]).sum()
+        smaller[i] = (sim <= tau_ln[i]).sum()
+    return taus, larger, smaller
+
+# Function that returns the observed tau_spatial and tau_ln of many pairs of years at once (X and Y are pairs x regions)
+def lima_observed(X, Y, w = None):
+    if w is None: w = active_dataset()['W_binary']
+    sparse = w.sparse.tocsr()
+    n = X.shape[1]
+    card = np.diff(sparse.indptr)
+    rows = np.repeat(np.arange(n), card)
+    upper = rows < sparse.indices
+    
+    incidence = scipy.sparse.csr_matrix((np.ones(len(rows)), (np.arange(len(rows)), rows)), shape = (len(rows), n))
+    concordance = np.sign((X[:, rows] - X[:, sparse.indices]) * (Y[:, rows] - Y[:, sparse.indices])) @ incidence
+    return {'tau_spatial': spatial_tau_values(X, Y, rows[upper], sparse.indices[upper]),
+            'tau_ln': np.where(card > 0, concordance / np.maximum(card, 1), np.nan)}
+
+# Function that returns tau_spatial and tau_ln and, when permutations > 0, their pseudo p-values (permutations = 0 skips the inference).
+def lima(y_initial, y_final, w = None, permutations = None, seed = 12345):
+    if w is None: w = active_dataset()['W_binary']
+    if permutations is None: permutations = lima_permutations
+    x = np.asarray(y_initial, dtype = float)
+    y = np.asarray(y_final, dtype = float)
+    
+    observed = lima_observed(x[None], y[None], w)
+    result = {'tau_spatial': observed['tau_spatial'][0],
+              'tau_ln': observed['tau_ln'][0],
+              'permutations': permutations}
+    
+    if permutations > 0:
+        blocks = [lima_permutation_block(*args) for args in lima_blocks(x, y, w, result['tau_ln'], permutations, seed)]
+        lima_inference(result, blocks, w)
+    return result
+
+# Function that returns the arguments of lima_permutation_block for each block of the permutations
+def lima_blocks(x, y, w, tau_ln, permutations, seed):
+    sparse = w.sparse.tocsr()
+    return [(x, y, sparse.indptr, sparse.indices, tau_ln, min(lima_block, permutations - start), seed + b)
+            for b, start in enumerate(range(0, permutations, lima_block))]
+
+# Function that adds the pseudo p-values computed from the blocks of permutations to the observed result of lima
+def lima_inference(result, blocks, w):
+    permutations = result['permutations']
+    card = np.diff(w.sparse.tocsr().indptr)
+    taus = np.concatenate([block[0] for block in blocks])
+    larger = (taus >= result['tau_spatial']).sum()
+    p = (larger + 1.0) / (permutations + 1.0)
+    if p > 0.5: p = (permutations - larger + 1.0) / (permutations + 1.0)
+    local = np.minimum(sum(block[1] for block in blocks), sum(block[2] for block in blocks))
+    result['taus'] = taus
+    result['tau_spatial_psim'] = p
+    result['tau_ln_p_sim'] = np.where(card > 0, (local + 1.0) / (permutations + 1.0), np.nan)
+    return result
+
+# Function that submits the LIMA job of a variable of the active dataset between two years: its blocks of permutations are tasks of the job
+# pool and the worker combines them into the pseudo p-values
+def submit_lima_job(job, var, year_initial, year_final, permutations, seed = 12345):
+    columns = active_dataset()['year_to_col']
+    w = active_dataset()['W_binary']
+    x = np.asarray(get_array(var)[:, columns[year_initial]], dtype = float)
+    y = np.asarray(get_array(var)[:, columns[year_final]], dtype = float)
+    result = lima(x, y, w, permutations = 0)
+    result['permutations'] = permutations
+    
+    def significance(blocks):
+        inference = lima_inference(dict(result), blocks, w)
+        return {'tau_spatial_psim': float(inference['tau_spatial_psim']), 'tau_ln_p_sim': inference['tau_ln_p_sim'].tolist()}
+    
+    tasks = [(lima_permutation_block, args) for args in lima_blocks(x, y, w, result['tau_ln'], permutations, seed)]
+    return submit_split_job(job, 'lima', tasks, significance)
+#### END OF LIMA ENGINE ###
+
+
+#### LIMA STORE ###
+# The observed spatial tau and tau_ln of every pair of years (earlier, later), stored as float32 in the cache folder and memory-mapped,
+# so the LIMA slider is a lookup. The pair (c0, c1), c0 < c1, is row c1 * (c1 - 1) / 2 + c0: the pairs of an appended year go at the end
+# and only those are computed. The stored years are checked against a hash of their columns, so a store is only extended if they did not change.
+
+def lima_pair_row(c0, c1):
+    return c1 * (c1 - 1) // 2 + c0
+
+# Function that returns the folder of the store of a variable and weights (it does not depend on the number of years, so it survives an append)
+def lima_store_path(var, w):
+    h = hashlib.sha1(('webstars-lima-v' + str(CACHE_VERSION) + '|' + var + '|' + str(active_dataset()['years'][0])).encode())
+    h.update('|'.join(active_dataset()['regions']['Name'].astype(str)).encode())
+    sparse = w.sparse.tocsr()
+    h.update(sparse.indptr.tobytes())
+    h.update(sparse.indices.tobytes())
+    return os.path.join(cache_root, 'lima-' + h.hexdigest()[:16])
+
+def column_hashes(values):
+    return [hashlib.sha1(np.ascontiguousarray(values[:, c]).tobytes()).hexdigest()[:16] for c in range(values.shape[1])]
+
+def save_array(path, values):
+    tmp_path = path + '.tmp-' + str(os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, values)
+    os.replace(tmp_path, path)
+
+# Function that loads the store of a variable, computing the pairs of the years it does not have yet
+def load_or_build_lima_store(var = 'PCR', w = None):
+    if w is None: w = active_dataset()['W_binary']
+    path = lima_store_path(var, w)
+    os.makedirs(path, exist_ok = True)
+    values = np.asarray(get_array(var), dtype = float)
+    hashes = column_hashes(values)
+    t = len(hashes)
+    
+    # The longest stored prefix of years that still matches the data (the columns file is written last, after the arrays)
+    stored = 0
+    for name in os.listdir(path):
+        if name.startswith('columns-') and name.endswith('.json'):
+            with open(os.path.join(path, name)) as f:
+                columns = json.load(f)
+            if len(columns) <= t and columns == hashes[:len(columns)]: stored = max(stored, len(columns))
+    
+    if stored < t:
+        tau_spatial = np.zeros(lima_pair_row(0, t), dtype = np.float32)
+        tau_ln = np.zeros((len(tau_spatial), values.shape[0]), dtype = np.float32)
+        if stored > 1:
+            tau_spatial[:lima_pair_row(0, stored)] = np.load(os.path.join(path, 'tau_spatial-{}.npy'.format(stored)))
+            tau_ln[:lima_pair_row(0, stored)] = np.load(os.path.join(path, 'tau_ln-{}.npy'.format(stored)))
+        
+        for c1 in range(max(stored, 1), t): # every earlier year against year c1 in one batch
+            observed = lima_observed(values[:, :c1].T, np.repeat(values[:, c1][None], c1, axis = 0), w)
+            tau_spatial[lima_pair_row(0, c1):lima_pair_row(0, c1 + 1)] = observed['tau_spatial']
+            tau_ln[lima_pair_row(0, c1):lima_pair_row(0, c1 + 1)] = observed['tau_ln']
+        
+        save_array(os.path.join(path, 'tau_spatial-{}.npy'.format(t)), tau_spatial)
+        save_array(os.path.join(path, 'tau_ln-{}.npy'.format(t)), tau_ln)
+        tmp_path = os.path.join(path, 'columns-{}.json.tmp-{}'.format(t, os.getpid()))
+        with open(tmp_path, 'w') as f:
+            json.dump(hashes, f)
+        os.replace(tmp_path, os.path.join(path, 'columns-{}.json'.format(t)))
+        
+        # The store that was extended is superseded (a worker that still has it memory-mapped keeps reading it)
+        if stored > 0:
+            for name in ['columns-{}.json', 'tau_spatial-{}.npy', 'tau_ln-{}.npy']:
+                try:
+                    os.remove(os.path.join(path, name.format(stored)))
+                except OSError:
+                    pass
+        stored = t
+    
+    return {'years': stored,
+            'tau_spatial': np.load(os.path.join(path, 'tau_spatial-{}.npy'.format(stored)), mmap_mode = 'r'),
+            'tau_ln': np.load(os.path.join(path, 'tau_ln-{}.npy'.format(stored)), mmap_mode = 'r')}
+
+# Function that returns the observed tau_spatial and tau_ln between two years, from the store when the pair is in it
+def lima_lookup(year_initial, year_final, var = 'PCR'):
+    c0, c1 = active_dataset()['year_to_col'][year_initial], active_dataset()['year_to_col'][year_final]
+    lima_stores = dataset_cache('lima')
+    if var not in lima_stores: lima_stores[var] = load_or_build_lima_store(var)
+    store = lima_stores[var]
+    if c0 < c1 < store['years']:
+        row = lima_pair_row(c0, c1)
+        return {'tau_spatial': float(store['tau_spatial'][row]), 'tau_ln': np.asarray(store['tau_ln'][row], dtype = float)}
+    return lima(get_array(var)[:, c0], get_array(var)[:, c1], permutations = 0)
+
+def warm_lima_store():
+    dataset_cache('lima')['PCR'] = load_or_build_lima_store('PCR')
+
+if os.environ.get('WEBSTARS_LIMA_STORE', '1') == '1': dataset_warmers.append(warm_lima_store)
+#### END OF LIMA STORE ###
+
+
+#### ROSE ENGINE ###
+# Directional LISA vectors (as giddy.directional.Rose) of a pair of years. The angles and lengths do not depend on k, so they are cached per pair
+# and every k only rebins them. The lag is linear, so under a permutation of the regions dy is W x dx[permutation]: the angles of all the
+# permutations come from one sparse product, are cached with the pair (as float32, they only feed the sector counts), and the sector counts
+# of any k are a single bincount. The pairs are cached with the dataset, in an LRU bounded by bytes (and counted in the dataset memory budget).
+
+rose_cache_budget = int(os.environ.get('WEBSTARS_ROSE_CACHE_MB', '64')) << 20
+rose_cache_lock = threading.Lock()
+rose_permutations = 999
+
+# Function that returns theta, r and the angles in [0, 2pi) of the observed and permuted vectors between two years
+def rose_vectors(var, year_initial, year_final, w = None, permutations = None, seed = 12345):
+    if w is None: w = active_dataset()['W']
+    if permutations is None: permutations = rose_permutations
+    rose_cache = dataset_cache('rose')
+    key = (var, year_initial, year_final, id(w), w.transform, permutations, seed)
+    with rose_cache_lock:
+        if key in rose_cache:
+            rose_cache[key] = rose_cache.pop(key)                     # most recently used last
+            return rose_cache[key][1]
+    
+    c0, c1 = active_dataset()['year_to_col'][year_initial], active_dataset()['year_to_col'][year_final]
+    values = get_array(var)
+    lag = lag_cube(var, w)
+    dx = np.asarray(values[:, c1] - values[:, c0], dtype = float)
+    dy = lag[:, c1] - lag[:, c0]
+    theta = np.arctan2(dy, dx)
+    vectors = {'theta': theta, 'r': np.hypot(dx, dy), 'utheta': np.where(theta < 0, 2 * np.pi + theta, theta)}
+    
+    if permutations > 0:
+        prng = np.random.RandomState(seed)
+        ids = prng.rand(permutations, len(dx)).argsort(axis = 1)
+        DX = dx[ids].T                                                 # (n, permutations)
+        theta_perm = np.arctan2(np.asarray(w.sparse.dot(DX)), DX).T
+        vectors['utheta_perm'] = np.where(theta_perm < 0, 2 * np.pi + theta_perm, theta_perm).astype(np.float32)
+    
+    with rose_cache_lock:
+        rose_cache[key] = (w, vectors)
+        while len(rose_cache) > 1 and sum(nested_nbytes(cached[1]) for cached in rose_cache.values()) > rose_cache_budget:
+            del rose_cache[next(iter(rose_cache))]
+    return vectors
+
+# Function that returns the cuts and sector counts of k sectors and, when the vectors have permutations, the two-sided pseudo p-values
+def rose_sectors(var, year_initial, year_final, k, w = None, permutations = None):
+    vectors = rose_vectors(var, year_initial, year_final, w, permutations)
+    sw = 2 * np.pi / k
+    cuts = np.arange(0.0, 2 * np.pi + sw, sw)
+    n_bins = len(cuts) - 1
+    
+    def sector(utheta): # same bins as np.histogram(utheta, cuts)
+        return np.minimum(np.searchsorted(cuts, utheta, side = 'right') - 1, n_bins - 1)
+    
+    rose = {'cuts': cuts, 'counts': np.bincount(sector(vectors['utheta']), minlength = n_bins)}
+    
+    if 'utheta_perm' in vectors:
+        permutations = len(vectors['utheta_perm'])
+        offsets = np.arange(permutations)[:, None] * n_bins
+        counts_perm = np.bincount((sector(vectors['utheta_perm']) + offsets).ravel(), minlength = permutations * n_bins).reshape(permutations, n_bins)
+        P = ((counts_perm >= rose['counts']).sum(axis = 0) + 1.0) / (permutations + 1.0)
+        rose['expected_perm'] = counts_perm.mean(axis = 0)
+        rose['p'] = np.where(P < 0.5, 2 * P, 2 * (1 - P))
+    return rose
+#### END OF ROSE ENGINE ###
+
+
+#### DENSITY ENGINE ###
+# Gaussian KDE (Silverman bandwidth, as stats.gaussian_kde(..., bw_method = 'silverman')) of every year of a variable on one shared grid.
+# The values are linearly binned on the grid and convolved with each year's kernel through one FFT for all the years, once per variable and dataset.
+# Densities at a point are read by interpolation and the curves are resampled to density_points over the range shown.
+
+density_grid_size = 8192
+density_points = 512
+
+# Function that returns the shared grid and the (n_years x grid) densities of a variable
+def density_curves(var):
+    density_cache = dataset_cache('density')
+    if var in density_cache: return density_cache[var]
+    
+    values = np.asarray(get_array(var), dtype = float).T                 # (n_years, n_regions)
+    t, n = values.shape
+    low, high = values.min(), values.max()
+    grid = np.linspace(low - 0.1 * abs(high), high + 0.1 * abs(high), density_grid_size)
+    delta = grid[1] - grid[0]
+    bandwidth = values.std(axis = 1, ddof = 1) * (n * 3.0 / 4.0) ** (-1.0 / 5.0)
+    
+    position = (values - grid[0]) / delta
+    left = np.clip(np.floor(position).astype(int), 0, density_grid_size - 2)
+    right_share = position - left
+    offsets = np.arange(t)[:, None] * density_grid_size
+    counts = (np.bincount((left + offsets).ravel(), (1 - right_share).ravel(), t * density_grid_size) +
+              np.bincount((left + 1 + offsets).ravel(), right_share.ravel(), t * density_grid_size)).reshape(t, density_grid_size)
+    
+    size = 2 * density_grid_size                                           # zero padded, so the circular convolution does not wrap around
+    lags = np.r_[0:density_grid_size, -density_grid_size:0] * delta
+    kernel = np.exp(-0.5 * (lags / bandwidth[:, None]) ** 2) / (n * bandwidth[:, None] * np.sqrt(2 * np.pi))
+    density = np.fft.irfft(np.fft.rfft(counts, size, axis = 1) * np.fft.rfft(kernel, axis = 1), size, axis = 1)[:, :density_grid_size]
+    
+    density_cache[var] = {'grid': grid, 'density': np.maximum(density, 0)}
+    return density_cache[var]
+
+# Function that returns the density of a year at some values
+def density_at(var, year, x):
+    curves = density_curves(var)
+    return np.interp(x, curves['grid'], curves['density'][active_dataset()['year_to_col'][year]])
+#### END OF DENSITY ENGINE ###
+
+
+#### FIGURE CACHE ###
+# Figures are cached under their normalized inputs (the effective year, and the hover and selection payloads reduced to the fields the figure
+# uses), the active dataset and the code, so a new dataset or an edited app.py never serves a stale figure. Each worker keeps a bounded LRU of decoded
+# figures and all the workers share a bounded SQLite store of the figures serialized with PlotlyJSONEncoder, in the cache folder.
+# A figure missing from both is computed once however many requests ask for it at the same time (a class opening the app, overlapping hovers):
+# the first request of a key computes it, the other requests of the worker wait for it and the other workers wait on a lock file of the key,
+# then all of them read the stored figure.
+
+figure_cache = collections.OrderedDict()
+figure_cache_size = 256
+figure_cache_lock = threading.Lock()
+figure_store_size = 5000
+figure_store_path = os.path.join(cache_root, 'figures.sqlite')
+figure_store_local = threading.local()
+figure_flights = {}           # key -> threading.Event set when the request computing the figure in this worker is done
+figure_flights_lock = threading.Lock()
+figure_flights_root = os.path.join(cache_root, 'flights')
+
+with open(os.path.abspath(__file__), 'rb') as f:
+    figure_namespace = hashlib.sha1(f.read()).hexdigest()[:16]
+
+# Function that returns the SQLite connection of the current thread (opened again after a fork)
+def figure_store():
+    if getattr(figure_store_local, 'pid', None) != os.getpid():
+        connection = sqlite3.connect(figure_store_path, timeout = 5, isolation_level = None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS figures (key TEXT PRIMARY KEY, figure TEXT, used REAL)')
+        figure_store_local.connection, figure_store_local.pid = connection, os.getpid()
+    return figure_store_local.connection
+
+def remember_figure(key, figure):
+    with figure_cache_lock:
+        figure_cache[key] = figure
+        figure_cache.move_to_end(key)
+        while len(figure_cache) > figure_cache_size:
+            figure_cache.popitem(last = False)
+    return figure
+
+# Function that returns the figure of a key from the LRU of the worker or from the SQLite store (None if neither has it)
+def stored_figure(key):
+    with figure_cache_lock:
+        if key in figure_cache:
+            figure_cache.move_to_end(key)
+            return figure_cache[key]
+    
+    try:
+        row = figure_store().execute('SELECT figure FROM figures WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            figure_store().execute('UPDATE figures SET used = ? WHERE key = ?', (time.time(), key))
+            return remember_figure(key, json.loads(row[0]))
+    except sqlite3.Error:
+        pass
+    return None
+
+def store_figure(key, figure):
+    serialized = json.dumps(figure, cls = plotly.utils.PlotlyJSONEncoder)
+    try:
+        store = figure_store()
+        store.execute('INSERT OR REPLACE INTO figures VALUES (?, ?, ?)', (key, serialized, time.time()))
+        store.execute('DELETE FROM figures WHERE key IN (SELECT key FROM figures ORDER BY used DESC LIMIT -1 OFFSET ?)', (figure_store_size,))
+    except sqlite3.Error:
+        pass
+    return remember_figure(key, json.loads(serialized))
+
+# Context manager holding the lock file of a key, so a single worker computes it. The holder removes the file before releasing it (the
+# figure is stored by then, so a request opening a new file finds it); a worker waiting on the removed file gets the lock and finds the figure
+@contextlib.contextmanager
+def figure_file_lock(key):
+    if fcntl is None:
+        yield
+        return
+    if not os.path.isdir(figure_flights_root): os.makedirs(figure_flights_root, exist_ok = True)
+    path = os.path.join(figure_flights_root, key + '.lock')
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            try:
+                if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino: os.remove(path)
+            except OSError:
+                pass
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+# Decorator that serves a callback figure from the cache, normalize(*args) returns what the figure depends on (it must be JSON serializable)
+def cached_figure(normalize):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args):
+            key = hashlib.sha1(json.dumps([figure_namespace, active_dataset()['key'], function.__name__, normalize(*args)]).encode()).hexdigest()
+            figure = stored_figure(key)
+            if figure is not None: return figure
+            
+            with figure_flights_lock:
+                flight = figure_flights.get(key)
+                leader = flight is None
+                if leader: flight = figure_flights[key] = threading.Event()
+            if not leader:
+                flight.wait()
+                figure = stored_figure(key)
+                if figure is not None: return figure
+                # The request computing it failed (or the LRU already dropped it), this one computes it
+            
+            try:
+                with figure_file_lock(key):
+                    figure = stored_figure(key)
+                    if figure is None: figure = store_figure(key, function(*args))
+            finally:
+                if leader:
+                    with figure_flights_lock:
+                        del figure_flights[key]
+                    flight.set()
+            return figure
+        return wrapper
+    return decorator
+
+# Function that returns the year of the active dataset nearest to a year: the widgets keep the years of the previous dataset until they are
+# moved, and the years of a dataset are not always consecutive (e.g. decennial)
+def nearest_year(year):
+    years = active_dataset()['years']
+    return years[int(np.argmin(np.abs(np.asarray(years) - int(year))))]
+
+# Function that resolves the year of the figures: the year hovered on the time series, otherwise the year of the slider
+def effective_year(year_hovered, year_selected_slider):
+    return nearest_year(year_selected_slider if year_hovered is None else year_hovered['points'][0]['x'])
+
+def clicked_region(state_clicked_choropleth):
+    if state_clicked_choropleth is None: return active_dataset()['default_region']
+    return point_region(state_clicked_choropleth['points'][0])
+
+# Function that keeps only some fields of the points of a selection (None when there is no selection)
+def selected_points(selection, fields):
+    if selection is None: return None
+    return [[point.get(field) for field in fields] for point in selection.get('points', [])]
+
+def map_inputs(type_data, year_hovered, year_selected_slider, n, browser_animation, map_layer, checkedValues):
+    return [cube_variable(type_data), effective_year(year_hovered, year_selected_slider), n % active_dataset()['n_regions'] if len(checkedValues) != 0 else -1,
+            len(browser_animation) != 0, map_layer]
+
+def scatter_inputs(type_data, year_hovered, year_selected_slider, states_selected_choropleth, states_selected_scatter, state_clicked_choropleth, browser_animation):
+    return [cube_variable(type_data), effective_year(year_hovered, year_selected_slider),
+            selected_points(states_selected_choropleth, ['customdata', 'text', 'z', 'pointIndex']), selected_points(states_selected_scatter, ['x', 'y']),
+            clicked_region(state_clicked_choropleth), len(browser_animation) != 0]
+
+def timeseries_inputs(year_hovered, year_selected_slider, type_data):
+    return [cube_variable(type_data), effective_year(year_hovered, year_selected_slider)]
+
+def boxplot_inputs(type_data, year_hovered, states_selected_choropleth, states_selected_scatter, year_selected_slider):
+    selection = states_selected_scatter if states_selected_scatter is not None else states_selected_choropleth
+    return [cube_variable(type_data), effective_year(year_hovered, year_selected_slider), sorted(p[0] for p in selected_points(selection, ['pointIndex']) or [])]
+
+def timepath_inputs(type_data, state_clicked_choropleth, year_hovered, year_selected_slider):
+    return [cube_variable(type_data), clicked_region(state_clicked_choropleth), effective_year(year_hovered, year_selected_slider)]
+
+def density_inputs(type_data, initial_year, final_year, state_clicked_choropleth, n, checkedValues):
+    initial_year, final_year = nearest_year(initial_year), nearest_year(final_year)
+    region = region_of_rank(initial_year, n % active_dataset()['n_regions'] + 1) if len(checkedValues) != 0 else clicked_region(state_clicked_choropleth)
+    return [cube_variable(type_data), str(initial_year), str(final_year), region]
+#### END OF FIGURE CACHE ###
+
+
+#### BROWSER PATCHES ###
+# On animation ticks and hovers only a few attributes of the map and the time series change (z, the highlight, the marker, the title).
+# The server sends the figure (from the figure cache) together with those attributes for every year into a dcc.Store, and a clientside callback
+# (assets/webstars.js) draws the year and the ranking into the figure, so ticks and hovers make no request. The server only sends a new
+# figure when an input that changes its structure fires (the variable, the layer, the browser animation, the dataset). The patch holds numbers
+# only, never geometry: the maps drawn from outlines get the fill color of every region in every year, and the browser takes the outlines
+# from the fill traces of the figure it has (one per color of the year of the figure, as outline_map_data groups them) and regroups them.
+
+# Function that returns what the browser needs to draw any year and ranking into the map of a variable sent for a year: the values, ranks and
+# region names (z, hover text and the heading of the ranking), or the LISA codes, Ii and pseudo p-values of the LISA layer
+def map_patch(var, map_layer, year):
+    values = np.asarray(get_array(var), dtype = float).T
+    patch = {'years': active_dataset()['years'],
+             'heading': map_heading_prefix(),
+             'values': values.tolist(),
+             'rank_to_region': np.asarray(get_array('rank_to_region')).tolist(),
+             'names': active_dataset()['regions']['Name'].tolist(),
+             'lisa': None,
+             'outline': None}
+    
+    z = values
+    if map_layer == 'lisa':
+        lisa = local_moran_series(var)
+        z = np.asarray(lisa['cluster']).T
+        patch['lisa'] = {'labels': lisa_labels, 'cluster': z.tolist(), 'Is': lisa['Is'].T.tolist(), 'p_sim': lisa['p_sim'].T.tolist()}
+    
+    if not active_dataset()['us_states']:
+        if map_layer == 'lisa': colorscale, zmin, zmax = lisa_colorscale, np.full(len(z), -0.5), np.full(len(z), 4.5)
+        else: colorscale, zmin, zmax = map_colorscale, values.min(axis = 1), values.max(axis = 1)
+        patch['outline'] = {'base_col': active_dataset()['year_to_col'][year],
+                            'colors': [color for bound, color in colorscale],
+                            'fill': [outline_fill(z[c], colorscale, zmin[c], zmax[c]).tolist() for c in range(len(z))],
+                            'zmin': zmin.tolist(),
+                            'zmax': zmax.tolist(),
+                            'highlight': outline_highlight([])}
+    return patch
+
+# Function that returns Moran's I, its z-score and pseudo p-value of every year, for the marker and the title of the time series
+def timeseries_patch(var):
+    moran = moran_series(var)
+    return {'years': active_dataset()['years'],
+            'I': moran['I'].tolist(),
+            'z_sim': moran['z_sim'].tolist(),
+            'p_sim': moran['p_sim'].tolist()}
+#### END OF BROWSER PATCHES ###
+
+
+#### ANIMATION FRAMES ###
+# With the browser animation on, the map and the scatter carry one frame per year (built once per variable and dataset from the value and lag arrays)
+# and plotly plays them in the browser with its own play / pause buttons and years slider, so the animation makes no callbacks at all.
+
+animation_frame_duration = 500    # milliseconds
+
+# Function that returns the play / pause buttons and the years slider of an animated figure, starting at a year
+def animation_controls(year):
+    years = active_dataset()['years']
+    steps = [dict(method = 'animate',
+                  label = str(y),
+                  args = [[str(y)], dict(mode = 'immediate', frame = dict(duration = 0, redraw = True), transition = dict(duration = 0))]) for y in years]
+    return dict(
+        updatemenus = [dict(type = 'buttons', showactive = False, x = 0.05, y = 0, xanchor = 'right', yanchor = 'top', pad = dict(t = 50, r = 10),
+                            buttons = [dict(label = 'Play', method = 'animate',
+                                            args = [None, dict(frame = dict(duration = animation_frame_duration, redraw = True), fromcurrent = True, transition = dict(duration = 0))]),
+                                       dict(label = 'Pause', method = 'animate',
+                                            args = [[None], dict(mode = 'immediate', frame = dict(duration = 0, redraw = False), transition = dict(duration = 0))])])],
+        sliders = [dict(active = active_dataset()['year_to_col'][year], steps = steps, x = 0.05, len = 0.95, currentvalue = dict(prefix = 'Year: '), pad = dict(t = 30))]
+    )
+
+# Function that returns the frames of the choropleth of a variable (z, text and title of every year)
+def map_frames(var, map_layer = 'values'):
+    animation_cache = dataset_cache('animation')
+    if ('map', var, map_layer) not in animation_cache:
+        values = get_array(var)
+        frames = []
+        for c, year in enumerate(active_dataset()['years']):
+            z, text = map_layer_values(var, year, map_layer)
+            frames.append(dict(name = str(year),
+                               traces = [0],
+                               data = [dict(z = z, text = text)],
+                               layout = dict(title = map_heading(values[:, c], year, -1))))
+        animation_cache[('map', var, map_layer)] = frames
+    return animation_cache[('map', var, map_layer)]
+
+# Function that returns the frames of the scatter of a variable (points, regression line and axis ranges of every year)
+def scatter_frames(var):
+    animation_cache = dataset_cache('animation')
+    if ('scatter', var) not in animation_cache:
+        values = np.asarray(get_array(var), dtype = float)
+        lags = lag_cube(var)
+        frames = []
+        for c, year in enumerate(active_dataset()['years']):
+            Var, VarLag = values[:, c], lags[:, c]
+            b, a = np.polyfit(Var, VarLag, 1)
+            x_min, x_max, y_min, y_max = float(Var.min()), float(Var.max()), float(VarLag.min()), float(VarLag.max())
+            frames.append(dict(name = str(year),
+                               traces = [0, 1],
+                               data = [dict(x = Var.tolist(), y = VarLag.tolist(), name = str(year)),
+                                       dict(x = [x_min, x_max], y = [float(a + x_min * b), float(a + x_max * b)])],
+                               layout = dict(xaxis = dict(range = [x_min - 0.05 * (x_max - x_min), x_max + 0.05 * (x_max - x_min)]),
+                                             yaxis = dict(range = [y_min - 0.05 * (y_max - y_min), y_max + 0.05 * (y_max - y_min)]))))
+        animation_cache[('scatter', var)] = frames
+    return animation_cache[('scatter', var)]
+#### END OF ANIMATION FRAMES ###
+
+
+# The default dataset is built (or read from the cache) and registered at startup, and the layout starts with its years and ranks
+csv_path = ps.examples.get_path('usjoin.csv')
+shp_path = ps.examples.get_path('us48.shp')
+default_dataset_id = load_or_build_dataset(csv_path, shp_path)['key']
 
- 
 step = 5
-years_by_step = list(map(str, list(range(first_year, last_year + 1, step))))         
 
-# For ranks dropdowns
-ranks_aux = [str(i) for i in sorted(us_tidy.Rank.unique())] # Converting each element to string (it could be list(map(str, years)))
-ranks_options = [{'label': i + 'th', 'value': i} for i in ranks_aux]
-ranks_options[0]['label'] = '1st'
-ranks_options[1]['label'] = '2nd'
-ranks_options[2]['label'] = '3rd'
+# Function that returns the years metadata of the browser-side callbacks and the options of the year and rank widgets of a dataset.
+# The sliders of consecutive years move by one year; otherwise they move only between their marks, one on every year of the dataset
+def dataset_controls(entry):
+    years = entry['years']
+    consecutive = years == list(range(years[0], years[-1] + 1))
+    ranks_options = [{'label': str(i) + 'th', 'value': str(i)} for i in range(1, entry['n_regions'] + 1)]
+    for i, label in enumerate(['1st', '2nd', '3rd'][:len(ranks_options)]): ranks_options[i]['label'] = label
+    return {'ui_metadata': {'first_year': years[0], 'last_year': years[-1], 'years': years, 'auto_interval': 2*1000, 'idle_interval': 24*60*60*1000},
+            'years_options': [{'label': str(i), 'value': str(i)} for i in years],
+            'marks': {str(year): str(year) for year in (years[::step] if consecutive else years)},
+            'slider_step': 1 if consecutive else None,
+            'ranks_options': ranks_options}
 
+default_controls = dataset_controls(dataset_entry(default_dataset_id))
 
+years = dataset_entry(default_dataset_id)['years']
+first_year = min(years)
+last_year = max(years)
 
-# For Global Moran`s I
-W = Queen.from_dataframe(us_tidy[us_tidy.Year == str(first_year)])
-W.transform = 'r'
-morans = us_tidy.groupby('Year').Income.apply(lambda x: ps.Moran(x, W).I).tolist()
+# Metadata embedded in the page for the browser-side callbacks (intervals in milliseconds)
+ui_metadata = default_controls['ui_metadata']
+years_options = default_controls['years_options']
+years_by_step = list(default_controls['marks'])
+slider_step = default_controls['slider_step']
+ranks_options = default_controls['ranks_options']
 
 
 
@@ -166,7 +1727,7 @@ app.layout = html.Div(
                     id='upload-shp',
                     children=html.Div([
                         'Drag and Drop or ',
-                        html.A('Select'), ' shapefile (.shp)'
+                        html.A('Select'), ' zipped shapefile (.zip) or GeoJSON'
                     ]),
                     style={
                         'width': '25%',
@@ -183,6 +1744,14 @@ app.layout = html.Div(
                     # Allow multiple files to be uploaded?
                     multiple=False
                     ),
+                
+                html.Div(id='upload-message', style={'textAlign': 'center', 'font-size': '110%'}),
+                html.Div(id='upload-status', style={'textAlign': 'center', 'font-size': '110%'}),
+                
+                # The dataset shown in this browser session, the upload being built and the polling of its build
+                dcc.Store(id='dataset-id', storage_type='session'),
+                dcc.Store(id='upload-job'),
+                dcc.Interval(id='upload-interval', interval=24*60*60*1000, n_intervals=0),
     
                 html.Img(src='data:image/png;base64,{}'.format(encoded_image_stars.decode()), 
                  style={'width': '150px',
@@ -206,6 +1775,7 @@ app.layout = html.Div(
                             id='years-slider',
                             min=min(years),
                             max=max(years),
+                            step=slider_step,
                             value=min(years),
                             marks={str(year): str(year) for year in years_by_step}
                         ),                        
@@ -214,6 +1784,12 @@ app.layout = html.Div(
                             interval=24*60*60*1000,
                             n_intervals=0
                         ),
+                        
+                        # Years and intervals read by the browser-side callbacks (assets/webstars.js)
+                        dcc.Store(
+                            id='ui-metadata',
+                            data=ui_metadata
+                        ),
                     
                 html.P('Select the Variable to analyze:', style={'margin-top': '35', 'font-size': '150%', 'font-weight': 'bold'}),    
                 dcc.RadioItems(
@@ -226,6 +1802,18 @@ app.layout = html.Div(
 
                             style={'margin-top': '0', 'font-size': '125%'}
                     ),
+                
+                html.P('Select the Map Layer:', style={'margin-top': '20', 'font-size': '150%', 'font-weight': 'bold'}),    
+                dcc.RadioItems(
+                            id='map_layer_selector',
+                            options=[
+                                {'label': 'Values of the Variable', 'value': 'values'},
+                                {'label': 'LISA Clusters (p < 0.05)', 'value': 'lisa'}
+                            ],
+                            value='values',
+
+                            style={'margin-top': '0', 'font-size': '125%'}
+                    ),
                     
                html.Div([ 
                html.P('Animation:', style={'margin-top': '20', 'font-size': '150%', 'font-weight': 'bold'})
@@ -246,6 +1834,14 @@ app.layout = html.Div(
                 values=[],
                 )]),
                 
+                # The map and the scatter get all the years as frames and play them in the browser
+                html.Div([
+                dcc.Checklist(
+                id='browser_animation-check',
+                options=[{'label': ' Animate in the Browser ', 'value': 'browser'}],
+                values=[],
+                )]),
+                
                 dcc.Interval(
                     id='spatial_interval-event',
                     interval=24*60*60*1000,
@@ -265,6 +1861,10 @@ app.layout = html.Div(
                                 id='timeseries-graph',
                             clear_on_unhover = 'True' # Sets the slider year when the mouse hover if off the graph
                             ),    
+                            
+                            # The figures of the map and the time series sent by the server, the browser draws the year into them
+                            dcc.Store(id='map-base'),
+                            dcc.Store(id='timeseries-base'),
                         
                             # dcc.Graph(
                             #    id='timepath-graph'
@@ -331,6 +1931,7 @@ app.layout = html.Div(
                             id='years-slider-rank-path',
                             min=min(years),
                             max=max(years),
+                            step=slider_step,
                             value=min(years),
                             marks={str(year): str(year) for year in years_by_step}
                         )
@@ -385,7 +1986,7 @@ app.layout = html.Div(
                         id='rose-range-slider',
                         min = first_year,
                         max = last_year,
-                        step = 1,
+                        step = slider_step,
                         marks = {str(year): str(year) for year in years_by_step},
                         value = [first_year, last_year]                        
                                 )], style = {'margin-bottom':60, 'margin-left':50, 'margin-right':50}),
@@ -473,16 +2074,34 @@ app.layout = html.Div(
                         id='rank-range-slider',
                         min = first_year,
                         max = last_year,
-                        step = 1,
+                        step = slider_step,
                         marks = {str(year): str(year) for year in years_by_step},
                         value = [first_year, last_year]                        
                                 )], style = {'margin-bottom':60}),
+                
+                html.Div([
+                        
+                html.P('Permutations of the pseudo p-values (0 skips the inference):', style = {'font-size': '150%', 'margin-top':25, 'font-weight': 'bold'}),
+                
+                dcc.Dropdown(
+                                id='lima-permutations',
+                                options = [{'label': i, 'value': i} for i in lima_permutation_options],
+                                value = lima_permutations,
+                                clearable = False
+                                )], style = {'margin-left':450,
+                                         'margin-right':450,
+                                         'margin-bottom':25}),
                         
                         
                         dcc.Graph(
                                 id='lima-neighborhood-graph'
                                 
-                            )], style={'width':1350, 
+                            ),
+                        
+                        # Pseudo p-values of the LIMA, filled in after the observed map is drawn: the permutations run as a job, polled until it is done
+                        dcc.Store(id='lima-job'),
+                        dcc.Interval(id='lima-job-interval', interval=24*60*60*1000, n_intervals=0),
+                        html.Div(id='lima-significance', style={'display': 'none'})], style={'width':1350, 
                                        'margin':25, 
                                        'float': 'left'}),
                                 
@@ -523,71 +2142,72 @@ app.layout = html.Div(
 
 
 ############################################################ 
-@app.callback(
+# The callbacks below only move widget state around, so they run in the browser (assets/webstars.js) and not in a server round-trip
+
+# set the interval-event using the Time Travelling check box
+app.clientside_callback(
+    ClientsideFunction(namespace = 'webstars', function_name = 'change_auto'),
     Output('interval-event', 'interval'), 
     [Input('auto-check', 'values')],
-    [State('interval-event', 'interval')]
+    [State('ui-metadata', 'data')]
 )
-def change_auto(checkedValues, interval):
-    #print(checkedValues, interval)
-    if (len(checkedValues) != 0): return 2*1000                      # AUTO is checked
-    else:                         return 24*60*60*1000               # AUTO is not checked
-
 
-#@app.callback(Output('years-slider', 'value'), [Input('interval-event', 'n_intervals')], events=[Event('interval-event', 'interval')])
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(namespace = 'webstars', function_name = 'update_slider'),
     Output('years-slider', 'value'), 
     [Input('interval-event', 'n_intervals')],
-    [State('years-slider', 'value'), State('years-slider', 'min'), State('years-slider', 'max'), State('auto-check', 'values')]
+    [State('years-slider', 'value'), State('auto-check', 'values'), State('ui-metadata', 'data')]
 )
-def update_slider(n, theYear, minValue, maxValue, checkedValues):
-    if (len(checkedValues) == 0): return theYear                     # AUTO is not checked
-    newValue = theYear + 1
-    if (newValue > maxValue): newValue = minValue
-    #print(n, theYear, minValue, maxValue, newValue, checkedValues)
-    return newValue
-
 
 # hide the options of the spatial_travel-check when AUTO is checked
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(namespace = 'webstars', function_name = 'hide_show_spatial_travel_checkbox'),
     Output('spatial_travel-check', 'options'), 
-    [Input('auto-check', 'values')],
+    [Input('auto-check', 'values')]
 )
-def hide_show_spatial_travel_checkbox(checkedValues):
-    print(checkedValues)
-    if (len(checkedValues) != 0): return []                                    # AUTO is checked
-    else: return [{'label': ' Spatial Travelling ', 'value': 'auto'}]    # AUTO is not checked
 
 # clear the values of the spatial_travel-check when AUTO is checked or not
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(namespace = 'webstars', function_name = 'clear_values_of_spatial_travel_checkbox'),
     Output('spatial_travel-check', 'values'), 
-    [Input('auto-check', 'values')],
+    [Input('auto-check', 'values')]
 )
-def clear_values_of_spatial_travel_checkbox(checkedValues):
-    #print(checkedValues)
-    return []
 
-# reset n_intervals in the Sspatial_interval-event when AUTO is checked or not
-# reset n_intervals in the Sspatial_interval-event when year is changed in the years-slider
-@app.callback(
+# reset n_intervals in the spatial_interval-event when AUTO is checked or not
+# reset n_intervals in the spatial_interval-event when year is changed in the years-slider
+app.clientside_callback(
+    ClientsideFunction(namespace = 'webstars', function_name = 'reset_n_intervals_of_spatial_interval_event'),
     Output('spatial_interval-event', 'n_intervals'), 
-    [Input('auto-check', 'values'), Input('years-slider','value')],
-    [State('spatial_interval-event', 'n_intervals')],
+    [Input('auto-check', 'values'), Input('years-slider','value')]
 )
-def reset_n_intervals_of_spatial_interval_event(checkedValues, year, oldValue):
-    #print(checkedValues, 'oldValue:', oldValue)
-    return 0
 
 # set the spatial_interval-event using the Spatial Travel Animation check box
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction(namespace = 'webstars', function_name = 'change_spatial_travel_interval'),
     Output('spatial_interval-event', 'interval'), 
     [Input('spatial_travel-check', 'values')],
-    [State('spatial_interval-event', 'interval'), State('spatial_interval-event', 'n_intervals')]
+    [State('ui-metadata', 'data')]
+)
+
+# draw the year and the ranking of the spatial travelling into the map sent by update_map
+app.clientside_callback(
+    ClientsideFunction(namespace = 'webstars', function_name = 'patch_map'),
+    Output('choropleth-graph', 'figure'), 
+    [Input('map-base', 'data'),
+     Input('timeseries-graph', 'hoverData'),
+     Input('years-slider', 'value'),
+     Input('spatial_interval-event', 'n_intervals')],
+    [State('spatial_travel-check', 'values')]
+)
+
+# move the marker and change the title of the time series sent by update_TimeSeries
+app.clientside_callback(
+    ClientsideFunction(namespace = 'webstars', function_name = 'patch_timeseries'),
+    Output('timeseries-graph', 'figure'), 
+    [Input('timeseries-base', 'data'),
+     Input('timeseries-graph', 'hoverData'),
+     Input('years-slider', 'value')]
 )
-def change_spatial_travel_interval(checkedValues, interval, n):
-    print(checkedValues, interval, n)
-    if (len(checkedValues) != 0): return 2*1000                      # AUTO is checked
-    else:                         return 24*60*60*1000               # AUTO is not checked
 
 ############################################################ 
 
@@ -595,64 +2215,148 @@ def change_spatial_travel_interval(checkedValues, interval, n):
 
 ############################################################
 
-@app.callback(
-    Output('choropleth-graph', 'figure'),
-    [Input('type_data_selector', 'value'),
-     Input('timeseries-graph','hoverData'), #'clickData'),
-     Input('years-slider','value'), 
-     Input('spatial_interval-event', 'n_intervals')],
-    [State('spatial_travel-check', 'values')],
-)
-def update_map(type_data, year_hovered, year_selected_slider, n, checkedValues):
-    
-    if type_data == 'raw': 
-        df_map = us_tidy[['Name','STATE_ABBR','Year','Income']].\
-                 pivot_table(index = ['Name','STATE_ABBR'], columns = 'Year', values = 'Income').\
-                 reset_index().\
-                 merge(us48_map, on='STATE_ABBR')                 
+# Function that returns the region holding a rank in a year (-1 for no rank, e.g. the 0th of spatial travelling)
+def region_of_rank(year, ranking):
+    if (ranking < 1): return -1
+    return int(get_array('rank_to_region')[active_dataset()['year_to_col'][int(year)], ranking - 1])
+
+# Function that returns the z of the highlight trace (1 for the region holding the rank)
+def rank_highlight(year, ranking):
+    z = np.zeros(active_dataset()['n_regions'], dtype = int)
+    region = region_of_rank(year, ranking)
+    if (region >= 0): z[region] = 1
+    return z.tolist()
+
+# Colorscale of the values on the map
+map_colorscale = [[0.0, '#eff3ff'],[0.2, '#c6dbef'],[0.4, '#9ecae1'],[0.6, '#6baed6'],[0.8, '#3182bd'],[1.0, '#08519c']]
+
+# Colors of the LISA cluster codes (lisa_labels), as bands of a colorscale over z from -0.5 to 4.5
+lisa_colors = ['#d9d9d9', '#d7191c', '#abd9e9', '#2c7bb6', '#fdae61']
+lisa_colorscale = [[bound, color] for k, color in enumerate(lisa_colors) for bound in [k / 5.0, (k + 1) / 5.0]]
+
+# Function that returns the z and the hover text of the map layer in a year: the values of the variable, or the LISA cluster codes
+def map_layer_values(var, year, map_layer):
+    regions = active_dataset()['regions']
+    col = active_dataset()['year_to_col'][int(year)]
+    if map_layer == 'lisa':
+        lisa = local_moran_series(var)
+        return (lisa['cluster'][:, col].tolist(),
+                ['{}<br>{} (Ii = {:.3f}, p = {:.3f})'.format(name, lisa_labels[k], Ii, p)
+                 for name, k, Ii, p in zip(regions['Name'], lisa['cluster'][:, col], lisa['Is'][:, col], lisa['p_sim'][:, col])])
+    return get_array(var)[:, col].tolist(), list(regions['Name'])
+
+def map_heading_prefix():
+    return 'Income of US by State in ' if active_dataset()['us_states'] else 'Income by Region in '
+
+# Function that returns the title of the map (with the region of the ranking highlighted while spatial travelling)
+def map_heading(values, year, ranking):
+    heading = map_heading_prefix() + str(year)
+    if (ranking >= 0):
+        msg = str(ranking) + 'th'
+        if (ranking == 1): msg = '1st'
+        if (ranking == 2): msg = '2nd'
+        if (ranking == 3): msg = '3rd'
+        region = region_of_rank(year, ranking)
+        if (region >= 0): msg += ' ' + str(active_dataset()['regions']['Name'][region]) + ': {0:.2f}'.format(values[region])
+        heading += '<br>(' + msg + ')'
+    return heading
+
+# Function that returns the traces of a map drawn from the outlines of the geometry store (the datasets that are not US states): one filled
+# trace per color of the colorscale and a trace of invisible markers at the centroids with the hover text, the colorbar and the region ids
+def outline_map_data(z, text, colorscale, zmin, zmax, colorbar, highlighted):
+    templates = geometry_traces()
+    fill_colors = np.array([color for bound, color in colorscale])[outline_fill(z, colorscale, zmin, zmax)]
+    
+    Outline_Data = []
+    for color in np.unique(fill_colors):
+        x, y = outline_xy(np.nonzero(fill_colors == color)[0])
+        Outline_Data.append(dict(
+                type = 'scatter',
+                mode = 'lines',
+                showlegend = False,
+                line = dict(color = 'white', width = 1),
+                x = x,
+                y = y,
+                fill = 'toself',
+                fillcolor = color,
+                hoverinfo = 'none'
+        ))
+    if (highlighted >= 0):
+        Outline_Data.append(outline_highlight([highlighted]))
+    Outline_Data.append(dict(
+                type = 'scatter',
+                mode = 'markers',
+                showlegend = False,
+                x = templates['centroid_x'],
+                y = templates['centroid_y'],
+                text = text,
+                customdata = list(range(len(text))),
+                hoverinfo = 'text',
+                marker = dict(size = 10, opacity = 0, color = z, colorscale = colorscale, cmin = zmin, cmax = zmax, showscale = True, colorbar = colorbar)
+        ))
+    return Outline_Data
+
+# Function that returns the index in the colorscale of the color of every z (the colorscale bounds are shares of zmax - zmin)
+def outline_fill(z, colorscale, zmin, zmax):
+    stops = np.array([bound for bound, color in colorscale])
+    share = (np.asarray(z, dtype = float) - zmin) / ((zmax - zmin) or 1.0)
+    return np.clip(np.searchsorted(stops, share, side = 'right') - 1, 0, len(stops) - 1)
+
+# Function that returns the trace highlighting some regions of a map drawn from outlines
+def outline_highlight(region_ids):
+    x, y = outline_xy(region_ids)
+    return dict(type = 'scatter', mode = 'lines', showlegend = False, line = dict(color = '#FFFF00', width = 3),
+                x = x, y = y, fill = 'toself', fillcolor = 'rgba(255, 255, 0, 0.5)', hoverinfo = 'none')
+
+@cached_figure(map_inputs)
+def map_figure(type_data, year_hovered, year_selected_slider, n, browser_animation, map_layer, checkedValues):
+
+    if type_data == 'raw':
         title_map = '(Raw)'
-    
+
     else:
-        df_map = us_tidy[['Name','STATE_ABBR','Year','PCR']].\
-                 pivot_table(index = ['Name','STATE_ABBR'], columns = 'Year', values = 'PCR').\
-                 reset_index().\
-                 merge(us48_map, on='STATE_ABBR')
         title_map = '(PCR)'
-    
-    rk_map = us_tidy[['Name','STATE_ABBR','Year','Rank']].\
-             pivot_table(index = ['Name','STATE_ABBR'], columns = 'Year', values = 'Rank').\
-             reset_index().\
-             merge(us48_map, on='STATE_ABBR')
-    
-    if year_hovered is None: 
-        year = year_selected_slider
-    
-    else:
-        year = year_hovered['points'][0]['x']
 
-    heading = 'Income of US by State in ' + str(year)
+    year = effective_year(year_hovered, year_selected_slider)
+
+    values = get_array(cube_variable(type_data))[:, active_dataset()['year_to_col'][int(year)]]
+    regions = active_dataset()['regions']
+    n_regions = active_dataset()['n_regions']
+
     ranking = -1
     if (len(checkedValues) != 0):
-        ranking = n % len(df_map[str(year)]) #+ 1
-        msg = str(ranking) + 'th'
-        if (ranking == 1): msg = '1st'
-        if (ranking == 2): msg = '2nd'
-        if (ranking == 3): msg = '3rd'
-        for i, rank in enumerate(rk_map[str(year)]):
-            if (rank == ranking): msg += ' ' + rk_map['Name'][i] + ': {0:.2f}'.format(df_map[str(year)][i])
-        heading += '<br>(' + msg + ')'
+        ranking = n % n_regions #+ 1
+    heading = map_heading(values, year, ranking)
     
-    scl  = [[0.0, '#eff3ff'],[0.2, '#c6dbef'],[0.4, '#9ecae1'],[0.6, '#6baed6'],[0.8, '#3182bd'],[1.0, '#08519c']]
+    scl  = map_colorscale
     scl2 = [[0.0, '#ffffff'],[1.0, '#FFFF00']]
 
+    layer_z, layer_text = map_layer_values(cube_variable(type_data), year, map_layer)
+    
+    # Regions that are not US states are drawn from their outlines (no browser animation, the frames change the choropleth)
+    if not active_dataset()['us_states']:
+        if map_layer == 'lisa':
+            Outline_Data = outline_map_data(layer_z, layer_text, lisa_colorscale, -0.5, 4.5,
+                                            dict(thickness = 10, title = 'LISA ' + title_map, tickvals = list(range(5)), ticktext = lisa_labels), region_of_rank(year, ranking))
+        else:
+            Outline_Data = outline_map_data(layer_z, layer_text, scl, float(values.min()), float(values.max()),
+                                            dict(thickness = 10, title = title_map), region_of_rank(year, ranking))
+        Outline_Layout = dict(title = heading,
+                              hovermode = 'closest',
+                              dragmode = 'select',
+                              xaxis = dict(visible = False),
+                              yaxis = dict(visible = False, scaleanchor = 'x'))
+        return dict(data = Outline_Data, layout = Outline_Layout)
+
     Choropleth_Data = [ dict(
                         type='choropleth',
                         colorscale = scl,
                         autocolorscale = False,
-                        locations = df_map['STATE_ABBR'],
-                        z = df_map[str(year)],
+                        locations = regions['STATE_ABBR'],
+                        z = layer_z,
                         locationmode = 'USA-states',
-                        text = df_map['Name'],
+                        text = layer_text,
+                        customdata = list(range(n_regions)),
                         marker = dict(
                             line = dict (
                                 color = 'rgb(255,255,255)',
@@ -662,6 +2366,10 @@ def update_map(type_data, year_hovered, year_selected_slider, n, checkedValues):
                             thickness = 10,
                             title = title_map)
                         ) ]
+    
+    if map_layer == 'lisa':
+        Choropleth_Data[0].update(colorscale = lisa_colorscale, zmin = -0.5, zmax = 4.5, hoverinfo = 'text',
+                                  colorbar = dict(thickness = 10, title = 'LISA ' + title_map, tickvals = list(range(5)), ticktext = lisa_labels))
         
     Choropleth_Layout =  dict(
                             title = heading,
@@ -671,21 +2379,19 @@ def update_map(type_data, year_hovered, year_selected_slider, n, checkedValues):
                             showlakes = True,
                             lakecolor = 'rgb(255, 255, 255)'),
                         )
-    Choropleth = {
-        'data': Choropleth_Data,
-        'layout': Choropleth_Layout
-    }
 
-    if (ranking > 0):
-        Choropleth_highlighted = [ dict(
+    # The highlight trace is always there (hidden when not spatial travelling), so the browser can show it or move it
+    Choropleth_highlighted = [ dict(
                         type='choropleth',
                         colorscale = scl2,
                         autocolorscale = False,
-                        locations = df_map['STATE_ABBR'],
-                        z = [1 if i == ranking else 0 for i in rk_map[str(year)]],
+                        locations = regions['STATE_ABBR'],
+                        z = rank_highlight(year, ranking),
                         showscale = False,
+                        visible = bool(ranking > 0),
                         locationmode = 'USA-states',
-                        text = df_map['Name'],
+                        text = regions['Name'],
+                        customdata = list(range(n_regions)),
                         marker = dict(
                             opacity = 0.5,
                             line = dict (
@@ -693,63 +2399,74 @@ def update_map(type_data, year_hovered, year_selected_slider, n, checkedValues):
                                 width = 0
                             ) ),
                         ) ]
-        Choropleth = {
-            'data': Choropleth_Data + Choropleth_highlighted,
-            'layout': Choropleth_Layout
-        }
+    Choropleth = {
+        'data': Choropleth_Data + Choropleth_highlighted,
+        'layout': Choropleth_Layout
+    }
+    
+    if (len(browser_animation) != 0):
+        Choropleth['frames'] = map_frames(cube_variable(type_data), map_layer)
+        Choropleth_Layout.update(animation_controls(year))
 
     return Choropleth
 
+@app.callback(
+    Output('map-base', 'data'),
+    [Input('dataset-id', 'data'),
+     Input('type_data_selector', 'value'),
+     Input('browser_animation-check', 'values'),
+     Input('map_layer_selector', 'value')],
+    [State('timeseries-graph','hoverData'), #'clickData'),
+     State('years-slider','value'), 
+     State('spatial_interval-event', 'n_intervals'),
+     State('spatial_travel-check', 'values')],
+)
+@dataset_callback
+def update_map(type_data, browser_animation, map_layer, year_hovered, year_selected_slider, n, checkedValues):
+    
+    # A change of year or of the ranking only changes the colors, the hover text, the highlight and the title: the browser draws them into
+    # this figure (patch_map), so the map only comes from the server when the variable, the layer, the animation or the dataset change
+    return {'figure': map_figure(type_data, year_hovered, year_selected_slider, n, browser_animation, map_layer, checkedValues),
+            'patch': map_patch(cube_variable(type_data), map_layer, effective_year(year_hovered, year_selected_slider))}
+
 ############################################################
 
 # https://dash.plot.ly/interactive-graphing
 
 @app.callback(
     Output('scatter-graph', 'figure'),
-    [Input('type_data_selector', 'value'),
+    [Input('dataset-id', 'data'),
+     Input('type_data_selector', 'value'),
      Input('timeseries-graph','hoverData'),#'clickData'),
      Input('years-slider','value'),
      Input('choropleth-graph','selectedData'),
      Input('scatter-graph','selectedData'),
-     Input('choropleth-graph','clickData')])
+     Input('choropleth-graph','clickData'),
+     Input('browser_animation-check', 'values')])
+@dataset_callback
+@cached_figure(scatter_inputs)
 def update_scatter(type_data, year_hovered, year_selected_slider, 
-                  states_selected_choropleth, states_selected_scatter, state_clicked_choropleth):
-    
-    if type_data == 'raw': 
-        df_map = us_tidy[['Name','STATE_ABBR','Year','Income']].\
-                 pivot_table(index = ['Name','STATE_ABBR'], columns = 'Year', values = 'Income').\
-                 reset_index().\
-                 merge(us48_map, on='STATE_ABBR')  
+                  states_selected_choropleth, states_selected_scatter, state_clicked_choropleth, browser_animation):
     
-    else:
-        df_map = us_tidy[['Name','STATE_ABBR','Year','PCR']].\
-                 pivot_table(index = ['Name','STATE_ABBR'], columns = 'Year', values = 'PCR').\
-                 reset_index().\
-                 merge(us48_map, on='STATE_ABBR')
+    var = cube_variable(type_data)
         
-    if year_hovered is None: 
-        year = year_selected_slider
+    year = effective_year(year_hovered, year_selected_slider)
+    regions = active_dataset()['regions']
+    n_regions = active_dataset()['n_regions']
     
-    else:
-        year = year_hovered['points'][0]['x']
-    
-    if ((states_selected_choropleth is None) & (state_clicked_choropleth is None)):
-        state_selected = ['California']
-        title_graph = state_selected[0]
-    
-    elif ((states_selected_choropleth is None) & (state_clicked_choropleth is not None)):
-        state_selected = [str(state_clicked_choropleth['points'][0]['text'])]
-        title_graph = state_selected[0]
+    if (states_selected_choropleth is None):
+        state_selected = [clicked_region(state_clicked_choropleth)]
+        title_graph = regions['Name'][state_selected[0]]
     
     else:
-        state_selected = [i['text'] for i in states_selected_choropleth['points']]# state_selected_choropleth['points'][0]['text']
+        state_selected = [point_region(i) for i in states_selected_choropleth['points']]
         title_graph = 'Multiple States'
     
-    VarLag = ps.lag_spatial(W, df_map[str(year)])
-    Var = df_map[str(year)]
+    VarLag = lag_cube(var)[:, active_dataset()['year_to_col'][int(year)]]
+    Var = get_array(var)[:, active_dataset()['year_to_col'][int(year)]]
 
-    states = np.array(df_map['Name'])
-    colors = np.where(np.isin(states, state_selected), '#FF0066', '#0066FF')
+    colors = np.full(n_regions, '#0066FF')
+    colors[state_selected] = '#FF0066'
     
     b,a = np.polyfit(Var, VarLag, 1)
     line0 = { 'x':[min(Var), max(Var)], 'y': [a + i * b for i in [min(Var), max(Var)]] }
@@ -762,7 +2479,8 @@ def update_scatter(type_data, year_hovered, year_selected_slider,
                             'marker': {'size': 10,
                                        'color': colors},
                             'name': str(year),
-                        'text': df_map['Name']},
+                        'text': regions['Name'],
+                        'customdata': list(range(n_regions))},
                         {
                             'x': line0['x'], 
                             'y': line0['y'],
@@ -775,15 +2493,15 @@ def update_scatter(type_data, year_hovered, year_selected_slider,
     varLag = []
     if (states_selected_choropleth is not None and
         'points' in states_selected_choropleth and len(states_selected_choropleth['points']) >= 2):
-        var = [v['z'] for v in states_selected_choropleth['points']]
-        varLag = [VarLag[v['pointIndex']] for v in states_selected_choropleth['points']]
+        var = [Var[point_region(v)] for v in states_selected_choropleth['points']]
+        varLag = [VarLag[point_region(v)] for v in states_selected_choropleth['points']]
     if (states_selected_scatter is not None and
         'points' in states_selected_scatter and len(states_selected_scatter['points']) >= 2):
         var = [v['x'] for v in states_selected_scatter['points']]
         #varLag = [VarLag[v['pointIndex']] for v in states_selected_scatter['points']]
         varLag = [v['y'] for v in states_selected_scatter['points']]
         
-    if (len(var) != 0 and len(varLag) != 0):
+    if (len(var) != 0 and len(varLag) != 0 and len(browser_animation) == 0): # the lines of a selection are not animated
         b,a = np.polyfit(var, varLag, 1)
         line1 = { 'x':[min(Var), max(Var)], 'y': [a + i * b for i in [min(Var), max(Var)]] }
         line2 = { 'x':[min(var), max(var)], 'y': [a + i * b for i in [min(var), max(var)]] }
@@ -829,6 +2547,11 @@ def update_scatter(type_data, year_hovered, year_selected_slider,
         'data': Scatter_Data,
         'layout': Scatter_Layout
     }
+    
+    if (len(browser_animation) != 0):
+        Scatter['frames'] = scatter_frames(cube_variable(type_data))
+        Scatter_Layout['title'] = 'Scatterplot <br>{} highlighted'.format(title_graph)
+        Scatter_Layout.update(animation_controls(year))
     return Scatter
 
 ############################################################
@@ -838,21 +2561,50 @@ def update_scatter(type_data, year_hovered, year_selected_slider,
     
 
 @app.callback(
-    Output('timeseries-graph', 'figure'),
-    [Input('timeseries-graph','hoverData'),#'clickData'),
-    Input('years-slider', 'value')],
-    [State('years-slider', 'min')]
+    Output('timeseries-base', 'data'),
+    [Input('dataset-id', 'data'),
+    Input('type_data_selector', 'value')],
+    [State('timeseries-graph','hoverData'),#'clickData'),
+    State('years-slider', 'value')]
 )
+@dataset_callback
+def update_TimeSeries(type_data, year_hovered, year_selected_slider):
+    
+    # A hover or a new year only moves the marker and changes the title, the browser does it (patch_timeseries)
+    return {'figure': timeseries_figure(year_hovered, year_selected_slider, type_data),
+            'patch': timeseries_patch(cube_variable(type_data))}
+
+def timeseries_title(moran, theIDX):
+    return 'Moran\'s I in {}: {:.3f} (z = {:.2f}, p = {:.3f})'.format(active_dataset()['years'][theIDX], moran['I'][theIDX], moran['z_sim'][theIDX], moran['p_sim'][theIDX])
 
-def update_TimeSeries(year_hovered, year_selected_slider, minValue):
+@cached_figure(timeseries_inputs)
+def timeseries_figure(year_hovered, year_selected_slider, type_data):
     
-    if year_hovered is None:    
-        theIDX = year_selected_slider - minValue
+    theIDX = active_dataset()['year_to_col'][effective_year(year_hovered, year_selected_slider)]
+    years = active_dataset()['years']
     
-    else:
-        theIDX = year_hovered['points'][0]['x'] - minValue    
+    moran = moran_series(cube_variable(type_data))
+    morans = moran['I'].tolist()
     
     TimeSeries_Data = [
+        {   # 95% band of the permutation null (the band is filled between these two traces)
+            'x': years, 
+            'y': moran['band_low'],
+            'mode': 'lines',
+            'line': {'width': 0},
+            'showlegend': False,
+            'hoverinfo': 'skip'
+        },
+        {
+            'x': years, 
+            'y': moran['band_high'],
+            'mode': 'lines',
+            'line': {'width': 0},
+            'fill': 'tonexty',
+            'fillcolor': 'rgba(150, 150, 150, 0.3)',
+            'name': 'Null 95%',
+            'hoverinfo': 'skip'
+        },
         {
             'x': years, 
             'y': morans,
@@ -871,6 +2623,7 @@ def update_TimeSeries(year_hovered, year_selected_slider, minValue):
     ]    
 
     TimeSeries_Choropleth_Layout = {
+        'title': timeseries_title(moran, theIDX),
         'xaxis': {'title': 'Years'},
         'yaxis': {'title': "Moran's I"}
     }
@@ -889,24 +2642,17 @@ def update_TimeSeries(year_hovered, year_selected_slider, minValue):
 
 @app.callback(
     Output('boxplot-graph', 'figure'),
-    [Input('type_data_selector', 'value'),
+    [Input('dataset-id', 'data'),
+     Input('type_data_selector', 'value'),
      Input('timeseries-graph','hoverData'),#'clickData'),
      Input('choropleth-graph','selectedData'),
      Input('scatter-graph','selectedData'),
      Input('years-slider','value')])
+@dataset_callback
+@cached_figure(boxplot_inputs)
 def update_boxplot(type_data, year_hovered, states_selected_choropleth, states_selected_scatter, year_selected_slider):
     
-    if type_data == 'raw': 
-        df_map = us_tidy[['Name','STATE_ABBR','Year','Income']].\
-                 pivot_table(index = ['Name','STATE_ABBR'], columns = 'Year', values = 'Income').\
-                 reset_index().\
-                 merge(us48_map, on='STATE_ABBR')  
-    
-    else:
-        df_map = us_tidy[['Name','STATE_ABBR','Year','PCR']].\
-                 pivot_table(index = ['Name','STATE_ABBR'], columns = 'Year', values = 'PCR').\
-                 reset_index().\
-                 merge(us48_map, on='STATE_ABBR')  
+    var = cube_variable(type_data)
 
     selected = []
     
@@ -915,18 +2661,14 @@ def update_boxplot(type_data, year_hovered, states_selected_choropleth, states_s
     if ((states_selected_scatter is not None)):
         selected = [i['pointIndex'] for i in states_selected_scatter['points']]
     
-    if year_hovered is None: 
-        year = year_selected_slider
-    
-    else:
-        year = year_hovered['points'][0]['x']
+    year = effective_year(year_hovered, year_selected_slider)
 
     #states = np.array(df_map['Name'])
     #colors = np.where(np.isin(states, state_selected), '#FF0066', '#0066FF')
         
     trace0 = dict(
         type = 'box',
-        y = df_map[str(year)],
+        y = get_array(var)[:, active_dataset()['year_to_col'][int(year)]],
         name = 'Boxplot of the variable',
         boxpoints='all',                                             # Show the underlying point of the boxplot
         jitter=0.15,                                                 # Degree of fuzziness
@@ -954,58 +2696,30 @@ def update_boxplot(type_data, year_hovered, states_selected_choropleth, states_s
 
 @app.callback(
     Output('timepath-graph', 'figure'),
-    [Input('type_data_selector', 'value'),
+    [Input('dataset-id', 'data'),
+     Input('type_data_selector', 'value'),
      Input('choropleth-graph','clickData'),
      Input('timeseries-graph','hoverData'),
-     Input('years-slider', 'value')],
-     [State('years-slider', 'min')])
-def update_timepath(type_data, state_clicked_choropleth, year_hovered, year_selected_slider, minValue): # , state_clicked_scatter
-    
-    if type_data == 'raw': 
-        df_map = us_tidy[['Name','STATE_ABBR','Year','Income']].\
-                 pivot_table(index = ['Name','STATE_ABBR'], columns = 'Year', values = 'Income').\
-                 reset_index().\
-                 merge(us48_map, on='STATE_ABBR')
+     Input('years-slider', 'value')])
+@dataset_callback
+@cached_figure(timepath_inputs)
+def update_timepath(type_data, state_clicked_choropleth, year_hovered, year_selected_slider): # , state_clicked_scatter
     
-    else:
-        df_map = us_tidy[['Name','STATE_ABBR','Year','PCR']].\
-                 pivot_table(index = ['Name','STATE_ABBR'], columns = 'Year', values = 'PCR').\
-                 reset_index().\
-                 merge(us48_map, on='STATE_ABBR')
+    var = cube_variable(type_data)
             
-    if (state_clicked_choropleth is None):
-        state_selected = 'California'
-    
-    if (state_clicked_choropleth is not None):
-        state_selected = str(state_clicked_choropleth['points'][0]['text'])
-    
+    state_row_index = clicked_region(state_clicked_choropleth)
+    state_selected = active_dataset()['regions']['Name'][state_row_index]
     
-    if year_hovered is None:    
-        theIDX = year_selected_slider - minValue
+    year = effective_year(year_hovered, year_selected_slider)
+    theIDX = active_dataset()['year_to_col'][year]
     
-    else:
-        theIDX = year_hovered['points'][0]['x'] - minValue
-    
-    if year_hovered is None:    
-        year = year_selected_slider
-    
-    else:
-        year = year_hovered['points'][0]['x']
-    
-    def calculate_lag_value(x):
-        return ps.lag_spatial(W, x)
-    
-    all_lagged = df_map[cols_to_calculate].apply(calculate_lag_value)
-    
-    state_row_index = list(df_map['Name']).index(state_selected)
-    
-    VarLag = all_lagged.iloc[state_row_index,:]
-    Var = df_map[cols_to_calculate].iloc[state_row_index,:]
+    VarLag = lag_cube(var)[state_row_index, :]
+    Var = get_array(var)[state_row_index, :]
     
     TimePath_Data = [
                         {
-                            'x': Var[[theIDX]], 
-                            'y': VarLag[[theIDX]],
+                            'x': [Var[theIDX]], 
+                            'y': [VarLag[theIDX]],
                             'mode': 'markers',
                             'marker': {'size': 12},
                             'name': '',
@@ -1038,84 +2752,58 @@ def update_timepath(type_data, state_clicked_choropleth, year_hovered, year_sele
 
 @app.callback(
     Output('density-graph', 'figure'),
-    [Input('type_data_selector', 'value'),
+    [Input('dataset-id', 'data'),
+     Input('type_data_selector', 'value'),
      Input('initial_years_dropdown','value'),
      Input('final_years_dropdown','value'),
      Input('choropleth-graph','clickData'),
      Input('spatial_interval-event', 'n_intervals')],
      [State('spatial_travel-check', 'values')])
+@dataset_callback
+@cached_figure(density_inputs)
 def update_density(type_data, initial_year, final_year, state_clicked_choropleth, n, checkedValues): # , state_clicked_scatter
     
-    if type_data == 'raw': 
-        df_map = us_tidy[['Name','STATE_ABBR','Year','Income']].\
-                 pivot_table(index = ['Name','STATE_ABBR'], columns = 'Year', values = 'Income').\
-                 reset_index().\
-                 merge(us48_map, on='STATE_ABBR')
+    var = cube_variable(type_data)
+    initial_year, final_year = nearest_year(initial_year), nearest_year(final_year)
+    initial_values = get_array(var)[:, active_dataset()['year_to_col'][int(initial_year)]]
+    final_values = get_array(var)[:, active_dataset()['year_to_col'][int(final_year)]]
     
-    else:
-        df_map = us_tidy[['Name','STATE_ABBR','Year','PCR']].\
-                 pivot_table(index = ['Name','STATE_ABBR'], columns = 'Year', values = 'PCR').\
-                 reset_index().\
-                 merge(us48_map, on='STATE_ABBR')
-        
-    rk_map = us_tidy[['Name','STATE_ABBR','Year','Rank']].\
-         pivot_table(index = ['Name','STATE_ABBR'], columns = 'Year', values = 'Rank').\
-         reset_index().\
-         merge(us48_map, on='STATE_ABBR')
-    
-    pair_of_years = [initial_year, final_year]
-    
-    
-    if (state_clicked_choropleth is None): 
-        chosen_state = 'California'
-    
-    if (state_clicked_choropleth is not None):
-        chosen_state = str(state_clicked_choropleth['points'][0]['text'])
-   
-    ranking = -1
     if (len(checkedValues) != 0):
-    	ranking = n % len(df_map[str(year)]) + 1
+        state_row_index = region_of_rank(initial_year, n % active_dataset()['n_regions'] + 1)
         
     else:
-       ranking = rk_map.loc[list(df_map['Name']).index(chosen_state), initial_year]
-    
-    state_row_index = list(rk_map[initial_year]).index(ranking)
+        state_row_index = clicked_region(state_clicked_choropleth)
+    chosen_state = active_dataset()['regions']['Name'][state_row_index]
     
-    initial_state_value = df_map[initial_year][state_row_index]
-    final_state_value = df_map[final_year][state_row_index]
+    initial_state_value = initial_values[state_row_index]
+    final_state_value = final_values[state_row_index]
         
-    X1 = np.array(df_map[pair_of_years[0]])
-    X2 = np.array(df_map[pair_of_years[1]])
-    
-    kde1 = stats.gaussian_kde(X1, bw_method = 'silverman')
-    kde2 = stats.gaussian_kde(X2, bw_method = 'silverman')
-    
-    # Joint grid
-    min_grid_aux = min(np.concatenate([X1, X2]))
-    max_grid_aux = max(np.concatenate([X1, X2]))
+    # Joint grid (the densities of every year are cached on a shared grid and resampled here to density_points)
+    min_grid_aux = min(np.concatenate([initial_values, final_values]))
+    max_grid_aux = max(np.concatenate([initial_values, final_values]))
     X_grid = np.linspace(min_grid_aux - 0.1 * abs(max_grid_aux), 
                          max_grid_aux + 0.1 * abs(max_grid_aux), 
-                         10000)
+                         density_points)
     
-    dens1 = kde1.evaluate(X_grid)
-    dens2 = kde2.evaluate(X_grid)
+    dens1 = density_at(var, int(initial_year), X_grid)
+    dens2 = density_at(var, int(final_year), X_grid)
     
     Density_Data = [  # Densities traces
                         {
-                            'x': X_grid, 
-                            'y': dens1,
+                            'x': X_grid.tolist(), 
+                            'y': dens1.tolist(),
                             'mode': 'lines',
                          'fill': 'tozeroy',
-                            'name': initial_year,
+                            'name': str(initial_year),
                         'text': 'Year of {}'.format(initial_year),
                         'line': {'color': '#AAAAFF',
                                  'width': 3}},
                           {
-                            'x': X_grid, 
-                            'y': dens2,
+                            'x': X_grid.tolist(), 
+                            'y': dens2.tolist(),
                             'mode': 'lines',
                          'fill': 'tozeroy',
-                            'name': final_year,
+                            'name': str(final_year),
                         'text': 'Year of {}'.format(final_year),
                         'line': {'color': '#FF0000',
                                  'width': 3}},
@@ -1124,7 +2812,7 @@ def update_density(type_data, initial_year, final_year, state_clicked_choropleth
                      # Segments of lines traces
                      {
                             'x': [initial_state_value, initial_state_value], # x-values of each point do draw a line
-                            'y': [0, kde1.evaluate(initial_state_value)[0]], # Extract only the value from an array: https://stackoverflow.com/questions/21030621/how-to-extract-value-from-a-numpy-ndarray
+                            'y': [0, float(density_at(var, int(initial_year), initial_state_value))],
                             'mode': 'lines',
                             'name': 'name_to_put',
                         'text': 'text_to_put_line',
@@ -1133,7 +2821,7 @@ def update_density(type_data, initial_year, final_year, state_clicked_choropleth
                                  'width': 3}},
                      {
                             'x': [final_state_value, final_state_value], # x-values of each point do draw a line
-                            'y': [0, kde2.evaluate(final_state_value)[0]],
+                            'y': [0, float(density_at(var, int(final_year), final_state_value))],
                             'mode': 'lines',
                             'name': 'name_to_put_line',
                         'text': 'text_to_put_line',
@@ -1163,25 +2851,27 @@ def update_density(type_data, initial_year, final_year, state_clicked_choropleth
 
 @app.callback(
     Output('rank-path-graph', 'figure'),
-    [Input('rankpath_dropdown','value'),
+    [Input('dataset-id', 'data'),
+     Input('rankpath_dropdown','value'),
      Input('years-slider-rank-path','value')]
 )
+@dataset_callback
 def update_rankpath(rank_selected, year_selected_slider): #year_hovered,
     
-    df_map = us_tidy[us_tidy.Year == str(first_year)]
-    
     #if year_hovered is None: 
-    year = year_selected_slider
+    year = nearest_year(year_selected_slider)
     
     #else:
     #    year = year_hovered['points'][0]['x']
 
-    chosen_rank = int(rank_selected)
+    chosen_rank = min(int(rank_selected), active_dataset()['n_regions'])
+    regions = active_dataset()['regions']
     
-    rp_aux = us_tidy[us_tidy.Rank == chosen_rank].sort_values('Year')
+    path_rows = get_array('rank_to_region')[:, chosen_rank - 1] # Region holding the chosen rank in each year
+    rp_aux = pd.DataFrame({'Year': [str(i) for i in active_dataset()['years']], 'Name': regions['Name'].values[path_rows]})
 
-    rp_aux['x'] = rp_aux.geometry.centroid.x
-    rp_aux['y'] = rp_aux.geometry.centroid.y
+    rp_aux['x'] = get_array('geom_centroid')[path_rows, 0]
+    rp_aux['y'] = get_array('geom_centroid')[path_rows, 1]
     rp_aux['dot_color'] = np.where(np.isin(rp_aux.Year, str(year)), '#0066FF', 'red')
     rp_aux['dot_size'] = np.where(np.isin(rp_aux.Year, str(year)), 14, 0)
 
@@ -1221,60 +2911,33 @@ def update_rankpath(rank_selected, year_selected_slider): #year_hovered,
     )
            
     
-    # I had to modify this code a little bit, because of the Multipolygon of shapely
-    # Also, I had to convert to lists the centroids and the exteriors of the Polygon
-    # http://toblerity.org/shapely/shapely.geometry.html
-    # Several States had multiple centroids... so I chose to take the value of the convex_hull
-    
-    
-    # Return Boggest polygon of a multipolygon object in python
-    def return_biggest(mp):
-        areas = [i.area for i in list(mp)]
-        biggest = mp[areas.index(max(areas))]
-        return biggest
-    
-    RankPath_Data = []
-    for index,row in df_map.iterrows():
-        if df_map['geometry'][index].type == 'Polygon':
-            x,y = row.geometry.exterior.xy
-            x = x.tolist()
-            y = y.tolist()
-            c_x,c_y = row.geometry.centroid.xy
-            c_x = c_x.tolist()
-            c_y = c_y.tolist()
-        elif df_map['geometry'][index].type == 'MultiPolygon':
-            x = return_biggest(df_map['geometry'][index]).exterior.xy[0].tolist()
-            y = return_biggest(df_map['geometry'][index]).exterior.xy[1].tolist()
-            c_x = [return_biggest(df_map['geometry'][index]).centroid.xy[0][0]]
-            c_y = [return_biggest(df_map['geometry'][index]).centroid.xy[1][0]]
-        else: 
-            print('stop')
-        county_outline = dict(
+    # One trace for all the outlines and one for all the centroids, from the templates built once per geometry source
+    templates = geometry_traces()
+    x, y = outline_xy(range(active_dataset()['n_regions']))
+    
+    RankPath_Data = [dict(
                 type = 'scatter',
+                mode = 'lines',
                 showlegend = False,
                 legendgroup = "shapes",
                 line = dict(color='black', width=1.5),
-                x=x,
-                y=y,
-                marker = dict(size=0.01), # Because of the hull_convex, some unusual dots appeared. So this argument removes them.
+                x = x,
+                y = y,
                 fill='toself',
                 fillcolor = 'lightyellow',
                 hoverinfo='none'
-        )
-        hover_point = dict(
+        ),
+        dict(
                 type = 'scatter',
+                mode = 'markers',
                 showlegend = False,
                 legendgroup = "centroids",
-                name = row.Name,
                 marker = dict(size=4, color = 'black'),
-                x = c_x, #df.centroid.x, #c_x
-                y = c_y, #df.centroid.y, #c_y
-                fill='toself',
-                fillcolor = 'red',
+                x = templates['centroid_x'],
+                y = templates['centroid_y'],
+                text = regions['Name'],
                 hoverinfo = 'none'
-        )
-        RankPath_Data.append(county_outline)
-        RankPath_Data.append(hover_point)
+        )]
     
     rankpath_lines = dict(
                     x = rp_aux['x'], 
@@ -1308,23 +2971,23 @@ def update_rankpath(rank_selected, year_selected_slider): #year_hovered,
     
 @app.callback(
     Output('markov-pooled-graph', 'figure'),
-    [Input('markov-pooled-classes-dropdown','value'),
+    [Input('dataset-id', 'data'),
+     Input('markov-pooled-classes-dropdown','value'),
      Input('markov-pooled-spatial-dropdown','value')])
+@dataset_callback
 def update_markov_pooled_graph(markov_class_value, markov_spatial_value):
     
-    smc_df_aux = us_tidy[['Name', 'Year', 'PCR']].pivot(index = 'Name', columns = 'Year', values = 'PCR')
-
-    sm = giddy.markov.Spatial_Markov(smc_df_aux, W, fixed = True, k = markov_class_value, m = markov_spatial_value)     
+    sm = spatial_markov('PCR', markov_class_value, markov_spatial_value)
     
-    shorrock_1 = mobility.markov_mobility(sm.p, measure="P")
-    shorrock_2 = mobility.markov_mobility(sm.p, measure="D")
-    som_con    = mobility.markov_mobility(sm.p, measure = "L2")
+    shorrock_1 = sm['shorrock_1']
+    shorrock_2 = sm['shorrock_2']
+    som_con    = sm['som_con']
     
     Heatmap_Data = [dict(
                         type = 'heatmap',
                         x = list(string.ascii_lowercase[0:markov_class_value]),
                         y = list(reversed(list(string.ascii_uppercase[0:markov_class_value]))),
-                        z = list(reversed(sm.p.tolist())) # Reversed list
+                        z = list(reversed(sm['p'].tolist())) # Reversed list
                         )]
     
     Heatmap_Layout = dict(title = '<b>Pooled Markov transition probability matrix</b> <br>Shorrock 1\'s: {}, Shorrock 2\'s: {}, Sommers and Conlisk\'s: {}</br>'.format(round(shorrock_1, 2), round(shorrock_2, 2), round(som_con, 2)),
@@ -1346,13 +3009,13 @@ def update_markov_pooled_graph(markov_class_value, markov_spatial_value):
     
 @app.callback(
     Output('markov-spatial-graph', 'figure'),
-    [Input('markov-pooled-classes-dropdown','value'),
+    [Input('dataset-id', 'data'),
+     Input('markov-pooled-classes-dropdown','value'),
      Input('markov-pooled-spatial-dropdown','value')])
+@dataset_callback
 def update_markov_spatial_graph(markov_class_value, markov_spatial_value):
     
-    smc_df_aux = us_tidy[['Name', 'Year', 'PCR']].pivot(index = 'Name', columns = 'Year', values = 'PCR')
-
-    sm = giddy.markov.Spatial_Markov(smc_df_aux, W, fixed = True, k = markov_class_value, m = markov_spatial_value)     
+    sm = spatial_markov('PCR', markov_class_value, markov_spatial_value)
     
     rows_number = math.ceil(markov_spatial_value/3)
     
@@ -1374,7 +3037,7 @@ def update_markov_spatial_graph(markov_class_value, markov_spatial_value):
                 name = 'Spatial Lag ' + str(i),
                 x = list(string.ascii_lowercase[0:markov_class_value]),
                 y = list(reversed(list(string.ascii_uppercase[0:markov_class_value]))),
-                z = list(reversed(sm.P[i])), # Reversed list
+                z = list(reversed(sm['P'][i])), # Reversed list
                 xaxis = xaxis_aux,
                 yaxis = yaxis_aux
                 )
@@ -1404,24 +3067,174 @@ def update_markov_spatial_graph(markov_class_value, markov_spatial_value):
 
 
 @app.callback(
-    Output('lima-neighborhood-graph', 'figure'),
-    [Input('rank-range-slider','value')]
+    [Output('upload-job', 'data'),
+     Output('upload-message', 'children')],
+    [Input('upload-csv', 'contents'),
+     Input('upload-shp', 'contents')],
+    [State('upload-csv', 'filename'),
+     State('upload-shp', 'filename')]
 )
-def update_lima_neighborhood(pair_years_range_slider):
+def ingest_upload(csv_contents, geometry_contents, csv_filename, geometry_filename):
     
-    us_tidy_map = us_tidy[us_tidy.Year == str(first_year)]
+    if csv_contents is None and geometry_contents is None: raise dash.exceptions.PreventUpdate()
+    if csv_contents is None: return None, 'Now upload the csv with one column per year'
+    if geometry_contents is None: return None, 'Now upload the regions as a zipped shapefile (.zip) or GeoJSON'
     
-    y_initial = us_tidy[us_tidy.Year == str(pair_years_range_slider[0])].PCR
-    y_final   = us_tidy[us_tidy.Year == str(pair_years_range_slider[1])].PCR
+    if not geometry_filename.lower().endswith(('.zip', '.geojson', '.json')):
+        return None, 'The regions must be a zipped shapefile (.zip) or GeoJSON'
     
-    global_spatial_tau = giddy.rank.SpatialTau(np.array(y_initial), np.array(y_final), W, 999)
+    return submit_upload(csv_contents, csv_filename, geometry_contents, geometry_filename), 'Files received: {} and {}'.format(csv_filename, geometry_filename)
+
+
+# The status is polled while the dataset is building, then the interval goes idle until the next upload
+@app.callback(
+    [Output('upload-status', 'children'),
+     Output('upload-interval', 'interval')],
+    [Input('upload-interval', 'n_intervals'),
+     Input('upload-job', 'data')]
+)
+def update_upload_status(n, dataset_id):
+    
+    if dataset_id is None: return '', ui_metadata['idle_interval']
+    return upload_status(dataset_id), 1000 if upload_pending(dataset_id) else ui_metadata['idle_interval']
+
+
+# The session switches to an upload once it is built
+@app.callback(
+    Output('dataset-id', 'data'),
+    [Input('upload-status', 'children')],
+    [State('upload-job', 'data')]
+)
+def select_uploaded_dataset(status, dataset_id):
     
-    tau_wr = giddy.rank.Tau_Local_Neighbor(y_initial, y_final, W, 999) 
-    #tau_wr
+    if dataset_id is None or not dataset_ready(dataset_id) or upload_pending(dataset_id): raise dash.exceptions.PreventUpdate()
+    return dataset_id
+
+
+# The years and ranks of the widgets follow the dataset
+@app.callback(
+    [Output('ui-metadata', 'data'),
+     Output('years-slider', 'min'),
+     Output('years-slider', 'max'),
+     Output('years-slider', 'marks'),
+     Output('years-slider', 'step'),
+     Output('years-slider-rank-path', 'min'),
+     Output('years-slider-rank-path', 'max'),
+     Output('years-slider-rank-path', 'marks'),
+     Output('years-slider-rank-path', 'step'),
+     Output('years-slider-rank-path', 'value'),
+     Output('initial_years_dropdown', 'options'),
+     Output('initial_years_dropdown', 'value'),
+     Output('final_years_dropdown', 'options'),
+     Output('final_years_dropdown', 'value'),
+     Output('rankpath_dropdown', 'options'),
+     Output('rankpath_dropdown', 'value'),
+     Output('rose-range-slider', 'min'),
+     Output('rose-range-slider', 'max'),
+     Output('rose-range-slider', 'marks'),
+     Output('rose-range-slider', 'step'),
+     Output('rose-range-slider', 'value'),
+     Output('rank-range-slider', 'min'),
+     Output('rank-range-slider', 'max'),
+     Output('rank-range-slider', 'marks'),
+     Output('rank-range-slider', 'step'),
+     Output('rank-range-slider', 'value')],
+    [Input('dataset-id', 'data')]
+)
+@dataset_callback
+def update_dataset_controls():
+    
+    controls = dataset_controls(active_dataset())
+    first_year, last_year = controls['ui_metadata']['first_year'], controls['ui_metadata']['last_year']
+    marks, slider_step = controls['marks'], controls['slider_step']
+    
+    return [controls['ui_metadata'],
+            first_year, last_year, marks, slider_step,
+            first_year, last_year, marks, slider_step, first_year,
+            controls['years_options'], str(first_year),
+            controls['years_options'], str(last_year),
+            controls['ranks_options'], '1',
+            first_year, last_year, marks, slider_step, [first_year, last_year],
+            first_year, last_year, marks, slider_step, [first_year, last_year]]
+
+
+@app.callback(
+    Output('lima-job', 'data'),
+    [Input('dataset-id', 'data'),
+     Input('rank-range-slider','value'),
+     Input('lima-permutations', 'value')]
+)
+@dataset_callback
+def update_lima_significance(pair_years_range_slider, permutations):
+    
+    dataset_id = active_dataset()['key']
+    year_initial, year_final = nearest_year(pair_years_range_slider[0]), nearest_year(pair_years_range_slider[1])
+    permutations = lima_permutations if permutations is None else int(permutations)
+    if permutations == 0: return {'job': None, 'dataset': dataset_id, 'pair': [year_initial, year_final], 'permutations': 0}
+    
+    # The same pair of years of a dataset with the same permutations is the same job, whichever session or worker asks for it
+    job = job_id('lima', dataset_id, 'PCR', year_initial, year_final, permutations)
+    submit_lima_job(job, 'PCR', year_initial, year_final, permutations)
+    
+    return {'job': job, 'dataset': dataset_id, 'pair': [year_initial, year_final], 'permutations': permutations}
+
+
+# The LIMA job is polled every second until it is done (or failed), then the interval goes idle until the next pair of years
+@app.callback(
+    [Output('lima-significance', 'children'),
+     Output('lima-job-interval', 'interval')],
+    [Input('lima-job-interval', 'n_intervals'),
+     Input('lima-job', 'data')]
+)
+def update_lima_job(n, lima_job_data):
+    
+    if lima_job_data is None: raise dash.exceptions.PreventUpdate()
+    
+    if lima_job_data['job'] is None:
+        return json.dumps(dict(lima_job_data, status = 'skipped', progress = 0.0)), ui_metadata['idle_interval']
+    
+    job = job_status(lima_job_data['job'])
+    significance = {'dataset': lima_job_data['dataset'], 'pair': lima_job_data['pair'], 'permutations': lima_job_data['permutations'], 'status': 'failed', 'progress': 0.0}
+    if job is not None and job['status'] == 'done':
+        significance.update(job['result'], status = 'done', progress = 1.0)
+    elif job_pending(job):
+        significance.update(status = 'pending', progress = job['progress'])
+    
+    return json.dumps(significance), 1000 if significance['status'] == 'pending' else ui_metadata['idle_interval']
+
+
+@app.callback(
+    Output('lima-neighborhood-graph', 'figure'),
+    [Input('dataset-id', 'data'),
+     Input('rank-range-slider','value'),
+     Input('lima-significance', 'children')],
+    [State('lima-permutations', 'value')]
+)
+@dataset_callback
+def update_lima_neighborhood(pair_years_range_slider, significance, permutations):
+    
+    # The observed statistics come from the all-pairs store, the pseudo p-values from the LIMA job when they belong to this dataset, pair of years
+    # and number of permutations (until then the map is drawn without them and the title shows the progress of the job)
+    pair = [nearest_year(year) for year in pair_years_range_slider]
+    observed = lima_lookup(pair[0], pair[1])
+    
+    significance = json.loads(significance) if significance else None
+    permutations = lima_permutations if permutations is None else int(permutations)
+    if permutations == 0: significance = None
+    elif significance is not None and (significance['dataset'] != active_dataset()['key'] or significance['pair'] != pair
+                                       or significance.get('permutations') != permutations):
+        significance = {'status': 'pending', 'progress': 0.0}
+    
+    title_p = ''
+    if significance is not None and significance['status'] == 'skipped': significance = None
+    if significance is not None and significance['status'] == 'done': title_p = ', p-value: {}'.format(round(significance['tau_spatial_psim'], 3))
+    elif significance is not None and significance['status'] == 'pending': title_p = ', p-value: computing {:.0%}'.format(significance['progress'])
+    elif significance is not None: title_p = ', p-value: unavailable'
+    if significance is not None and significance['status'] != 'done': significance = None
     
     LIMA_Layout = dict(
         projection = dict(type='albers usa'),
-        title = '<b>Neighbor set LIMA between {} and {} (Spatial Kendall\'s Tau: {})</b>'.format(str(pair_years_range_slider[0]),str(pair_years_range_slider[1]), str(round(global_spatial_tau.tau_spatial, 2))),
+        title = '<b>Neighbor set LIMA between {} and {} (Spatial Kendall\'s Tau: {})</b>'.format(str(pair[0]),str(pair[1]), str(round(observed['tau_spatial'], 2)) + title_p),
         titlefont = {"size": 24,
                      "family": "Courier New"},
         hovermode = 'closest',
@@ -1453,51 +3266,53 @@ def update_lima_neighborhood(pair_years_range_slider):
     )
            
     
-    # I had to modify this code a little bit, because of the Multipolygon of shapely
-    # Also, I had to convert to lists the centroids and the exteriors of the Polygon
-    # http://toblerity.org/shapely/shapely.geometry.html
-    # Several States had multiple centroids... so I chose to take the value of the convex_hull
-    
-    
-    # Return Boggest polygon of a multipolygon object in python
-    def return_biggest(mp):
-        areas = [i.area for i in list(mp)]
-        biggest = mp[areas.index(max(areas))]
-        return biggest
-    
     cmap = matplotlib.cm.get_cmap('Reds') #matplotlib.cm.get_cmap('Spectral')
     
+    # The regions sharing a fill color are drawn as one trace and the hover text goes in a single (invisible) centroid trace
+    templates = geometry_traces()
+    fill_colors = np.array([matplotlib.colors.rgb2hex(cmap(t)) for t in observed['tau_ln']])
+    
     LIMA_Data = []
-    for index,row in us_tidy_map.iterrows():
-        if us_tidy_map['geometry'][index].type == 'Polygon':
-            x,y = row.geometry.exterior.xy
-            x = x.tolist()
-            y = y.tolist()
-            c_x,c_y = row.geometry.centroid.xy
-            c_x = c_x.tolist()
-            c_y = c_y.tolist()
-        elif us_tidy_map['geometry'][index].type == 'MultiPolygon':
-            x = return_biggest(us_tidy_map['geometry'][index]).exterior.xy[0].tolist()
-            y = return_biggest(us_tidy_map['geometry'][index]).exterior.xy[1].tolist()
-            c_x = [return_biggest(us_tidy_map['geometry'][index]).centroid.xy[0][0]]
-            c_y = [return_biggest(us_tidy_map['geometry'][index]).centroid.xy[1][0]]
-        else: 
-            print('stop')
-        county_outline = dict(
+    for color in np.unique(fill_colors):
+        x, y = outline_xy(np.nonzero(fill_colors == color)[0])
+        LIMA_Data.append(dict(
                 type = 'scatter',
+                mode = 'lines',
                 showlegend = False,
                 legendgroup = "shapes",
                 line = dict(color='black', width=1.5),
                 x = x,
                 y = y,
-                marker = dict(size=0.01), # Because of the hull_convex, some unusual dots appeared. So this argument removes them.
                 fill='toself',
-                fillcolor = matplotlib.colors.rgb2hex(cmap(tau_wr.tau_ln[index])),
-                colorscale = 'Viridis',
+                fillcolor = color,
+                hoverinfo = 'none'
+        ))
+    LIMA_Data.append(dict(
+                type = 'scatter',
+                mode = 'markers',
+                showlegend = False,
+                legendgroup = "centroids",
+                marker = dict(size=10, opacity=0),
+                x = templates['centroid_x'],
+                y = templates['centroid_y'],
                 hoverinfo = 'text',
-                text = 'LIMA: ' + str(round(tau_wr.tau_ln[index], 3))
-        )
-        LIMA_Data.append(county_outline)       
+                text = ['LIMA: ' + str(round(t, 3)) for t in observed['tau_ln']]
+        ))
+    
+    if significance is not None:
+        p_sim = np.array(significance['tau_ln_p_sim'])
+        significant = np.nonzero(p_sim < 0.05)[0]
+        LIMA_Data[-1]['text'] = ['LIMA: {} (p-value: {})'.format(round(t, 3), round(p, 3)) for t, p in zip(observed['tau_ln'], p_sim)]
+        LIMA_Data.append(dict(
+                type = 'scatter',
+                mode = 'markers',
+                showlegend = False,
+                legendgroup = "significance",
+                marker = dict(size=8, color='black', symbol='star'),
+                x = [templates['centroid_x'][i] for i in significant],
+                y = [templates['centroid_y'][i] for i in significant],
+                hoverinfo = 'none'
+        ))
     
     LIMA = dict(data = LIMA_Data, layout = LIMA_Layout)
     return LIMA
@@ -1514,32 +3329,47 @@ def update_lima_neighborhood(pair_years_range_slider):
 
 @app.callback(
     Output('rose-graph', 'figure'),
-    [Input('rose-range-slider','value'),
+    [Input('dataset-id', 'data'),
+     Input('rose-range-slider','value'),
      Input('rose-k','value')]
 )
+@dataset_callback
 def update_rose(rose_pair_years_range_slider, rose_k):
     
-    y_initial = us_tidy[us_tidy.Year == str(rose_pair_years_range_slider[0])].PCR
-    y_final   = us_tidy[us_tidy.Year == str(rose_pair_years_range_slider[1])].PCR
-    
-    Y = np.swapaxes(np.array([y_initial, y_final]), 0, 1)
-
-    r4 = giddy.directional.Rose(Y, W, k = rose_k)
-    r_aux = list(map(math.degrees, r4.theta.tolist()))
+    # The vectors of the pair are cached, changing k only rebins them
+    year_initial, year_final = nearest_year(rose_pair_years_range_slider[0]), nearest_year(rose_pair_years_range_slider[1])
+    r4 = rose_vectors('PCR', year_initial, year_final)
+    sectors = rose_sectors('PCR', year_initial, year_final, rose_k)
+    r_aux = np.degrees(r4['theta']).tolist()
+    sector_width = 360.0 / rose_k
     
     Rose_Data = [dict(
         type = 'scatterpolargl',
-        r = r4.r.tolist(),
+        r = r4['r'].tolist(),
         theta = r_aux,
         mode = 'markers',
         marker = dict(
             color = 'peru'
         )
+        ),
+        dict(
+        type = 'barpolar',
+        r = sectors['counts'].tolist(),
+        theta = (np.degrees(sectors['cuts'][:-1]) + sector_width / 2).tolist(),
+        width = [sector_width] * len(sectors['counts']),
+        text = ['Expected: {}<br>p-value: {}'.format(round(e, 2), round(p, 3)) for e, p in zip(sectors['expected_perm'], sectors['p'])],
+        marker = dict(
+            color = ['peru' if p < 0.05 else 'burlywood' for p in sectors['p']],
+            line = dict(color = 'white')
+        ),
+        subplot = 'polar2'
         )]
 
     Rose_Layout = dict(
-        title = '<b>Rose for {} and {} (k = {})</b>'.format(rose_pair_years_range_slider[0], rose_pair_years_range_slider[1], rose_k),
-        showlegend = False
+        title = '<b>Rose for {} and {} (k = {})</b>'.format(year_initial, year_final, rose_k),
+        showlegend = False,
+        polar = dict(domain = dict(x = [0, 0.46])),
+        polar2 = dict(domain = dict(x = [0.54, 1]))
     )
     
     Rose_Fig = dict(data = Rose_Data, layout = Rose_Layout)
@@ -0,0 +1,160 @@
+// Browser-side callbacks of the widgets that only move UI state around (registered with app.clientside_callback in app.py).
+// The years and the intervals come from the 'ui-metadata' store embedded in the page, so none of them needs the server.
+// The map and the time series come from the server once per variable (the 'map-base' and 'timeseries-base' stores, see BROWSER PATCHES
+// in app.py) and the year, the hover and the spatial travelling are drawn into them here.
+
+// column of the year hovered in the time series, or else of the year of the years-slider (the nearest year of the dataset)
+function year_column(years, hoverData, sliderYear) {
+    var year = (hoverData && hoverData.points && hoverData.points.length) ? Number(hoverData.points[0].x) : sliderYear;
+    var col = 0;
+    for (var c = 1; c < years.length; c++) {
+        if (Math.abs(years[c] - year) < Math.abs(years[col] - year)) col = c;
+    }
+    return col;
+}
+
+// number with a fixed number of decimals, written as Python writes it
+function fixed(value, decimals) {
+    if (value === null || value === undefined || isNaN(value)) return 'nan';
+    return Number(value).toFixed(decimals);
+}
+
+// title of the map (map_heading in app.py)
+function map_heading(patch, col, ranking, region) {
+    var heading = patch.heading + patch.years[col];
+    if (ranking < 0) return heading;
+    var msg = ranking === 1 ? '1st' : ranking === 2 ? '2nd' : ranking === 3 ? '3rd' : ranking + 'th';
+    if (region >= 0) msg = msg + ' ' + patch.names[region] + ': ' + fixed(patch.values[col][region], 2);
+    return heading + '<br>(' + msg + ')';
+}
+
+// hover text of the map in a year: the region names, or the LISA cluster of every region (map_layer_values in app.py)
+function map_text(patch, col) {
+    if (!patch.lisa) return patch.names;
+    var lisa = patch.lisa;
+    return patch.names.map(function(name, i) {
+        return name + '<br>' + lisa.labels[lisa.cluster[col][i]] + ' (Ii = ' + fixed(lisa.Is[col][i], 3) + ', p = ' + fixed(lisa.p_sim[col][i], 3) + ')';
+    });
+}
+
+// regions of each fill color in a year, in ascending order, by color
+function color_groups(outline, col) {
+    var groups = {};
+    outline.fill[col].forEach(function(k, i) {
+        var color = outline.colors[k];
+        (groups[color] = groups[color] || []).push(i);
+    });
+    return groups;
+}
+
+// outline (x and y, ending with null) of every region, cut from the fill traces of the figure sent by the server: they come first, one per
+// color of its year in sorted order, each joining the outlines of its regions in ascending order (kept for the last figure sent)
+var last_outlines = {'data': null, 'outlines': null};
+function region_outlines(baseData, outline) {
+    if (last_outlines.data === baseData) return last_outlines.outlines;
+    var groups = color_groups(outline, outline.base_col);
+    var outlines = [];
+    Object.keys(groups).sort().forEach(function(color, t) {
+        var x = baseData[t].x, y = baseData[t].y, start = 0, k = 0;
+        for (var p = 0; p < x.length; p++) {
+            if (x[p] !== null) continue;
+            outlines[groups[color][k++]] = [x.slice(start, p + 1), y.slice(start, p + 1)];
+            start = p + 1;
+        }
+    });
+    last_outlines = {'data': baseData, 'outlines': outlines};
+    return outlines;
+}
+
+// traces of a map drawn from outlines (outline_map_data in app.py): one filled trace per color, the highlight and the centroid markers
+function outline_traces(baseData, outline, col, z, text, region) {
+    var outlines = region_outlines(baseData, outline);
+    var groups = color_groups(outline, col);
+    var data = Object.keys(groups).sort().map(function(color) {
+        var x = [], y = [];
+        groups[color].forEach(function(i) {
+            Array.prototype.push.apply(x, outlines[i][0]);
+            Array.prototype.push.apply(y, outlines[i][1]);
+        });
+        return Object.assign({}, baseData[0], {'x': x, 'y': y, 'fillcolor': color});
+    });
+    if (region >= 0) data.push(Object.assign({}, outline.highlight, {'x': outlines[region][0], 'y': outlines[region][1]}));
+    var centroids = baseData[baseData.length - 1];
+    var marker = Object.assign({}, centroids.marker, {'color': z, 'cmin': outline.zmin[col], 'cmax': outline.zmax[col]});
+    data.push(Object.assign({}, centroids, {'text': text, 'marker': marker}));
+    return data;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    webstars: {
+
+        // set the interval-event using the Time Travelling check box
+        change_auto: function(checkedValues, metadata) {
+            if ((checkedValues || []).length !== 0) return metadata.auto_interval;    // AUTO is checked
+            else                                    return metadata.idle_interval;    // AUTO is not checked
+        },
+
+        // move the years-slider to the next year of the dataset (back to the first year after the last one) on every tick of the interval-event
+        update_slider: function(n, theYear, checkedValues, metadata) {
+            if ((checkedValues || []).length === 0) return theYear;                   // AUTO is not checked
+            var later = metadata.years.filter(function(year) { return year > theYear; });
+            return later.length !== 0 ? later[0] : metadata.years[0];
+        },
+
+        // hide the options of the spatial_travel-check when AUTO is checked
+        hide_show_spatial_travel_checkbox: function(checkedValues) {
+            if ((checkedValues || []).length !== 0) return [];                        // AUTO is checked
+            else return [{'label': ' Spatial Travelling ', 'value': 'auto'}];         // AUTO is not checked
+        },
+
+        // clear the values of the spatial_travel-check when AUTO is checked or not
+        clear_values_of_spatial_travel_checkbox: function(checkedValues) {
+            return [];
+        },
+
+        // reset n_intervals in the spatial_interval-event when AUTO is checked or not, or when the year is changed in the years-slider
+        reset_n_intervals_of_spatial_interval_event: function(checkedValues, year) {
+            return 0;
+        },
+
+        // set the spatial_interval-event using the Spatial Travelling check box
+        change_spatial_travel_interval: function(checkedValues, metadata) {
+            if ((checkedValues || []).length !== 0) return metadata.auto_interval;    // AUTO is checked
+            else                                    return metadata.idle_interval;    // AUTO is not checked
+        },
+
+        // draw the year and the ranking of the spatial travelling into the map (colors, hover text, highlight and title)
+        patch_map: function(base, hoverData, sliderYear, n, checkedValues) {
+            if (!base) return {'data': [], 'layout': {}};
+            var patch = base.patch;
+            var col = year_column(patch.years, hoverData, sliderYear);
+            var ranking = (checkedValues || []).length !== 0 ? n % patch.names.length : -1;   // Spatial Travelling is checked
+            var region = ranking >= 1 ? patch.rank_to_region[col][ranking - 1] : -1;
+            var z = patch.lisa ? patch.lisa.cluster[col] : patch.values[col];
+            var text = map_text(patch, col);
+            var data;
+            if (patch.outline) {
+                data = outline_traces(base.figure.data, patch.outline, col, z, text, region);
+            } else {
+                data = base.figure.data.slice();
+                data[0] = Object.assign({}, data[0], {'z': z, 'text': text});
+                data[1] = Object.assign({}, data[1], {'z': patch.names.map(function(name, i) { return i === region ? 1 : 0; }), 'visible': ranking > 0});
+            }
+            var layout = Object.assign({}, base.figure.layout, {'title': map_heading(patch, col, ranking, region)});
+            return Object.assign({}, base.figure, {'data': data, 'layout': layout});
+        },
+
+        // move the marker of the year to the year hovered or selected and write its Moran's I in the title of the time series
+        patch_timeseries: function(base, hoverData, sliderYear) {
+            if (!base) return {'data': [], 'layout': {}};
+            var patch = base.patch;
+            var col = year_column(patch.years, hoverData, sliderYear);
+            var data = base.figure.data.slice();
+            data[3] = Object.assign({}, data[3], {'x': [patch.years[col]], 'y': [patch.I[col]]});
+            var title = "Moran's I in " + patch.years[col] + ': ' + fixed(patch.I[col], 3) +
+                        ' (z = ' + fixed(patch.z_sim[col], 2) + ', p = ' + fixed(patch.p_sim[col], 3) + ')';
+            var layout = Object.assign({}, base.figure.layout, {'title': title});
+            return Object.assign({}, base.figure, {'data': data, 'layout': layout});
+        }
+    }
+});
@@ -0,0 +1,89 @@
+# Regression check of the vectorized engines of app.py against the packages they replace (giddy, esda and libpysal), on the bundled US states
+# (usjoin.csv and us48.shp), and of the weights builder on us48.shp and columbus.shp. Run `python check_engines.py` after changing an engine: it prints one line per comparison and exits with status 1
+# if any of them does not match. The permutations are drawn differently from the packages, so only the statistics that do not depend on the
+# draws are compared.
+
+import sys
+import copy
+import warnings
+import numpy as np
+import geopandas as gpd
+import libpysal
+import esda
+import giddy
+from giddy import mobility
+
+import app as webstars
+
+warnings.filterwarnings('ignore')
+
+mismatches = []
+
+def check(name, ok):
+    print('{:<70} {}'.format(name, 'ok' if ok else 'MISMATCH'))
+    if not ok: mismatches.append(name)
+
+# Spatial Markov: the whole grid of the dropdowns (k in 1..9, m in 3, 6, 9) against giddy.markov.Spatial_Markov(..., fixed = True)
+def check_markov():
+    w = webstars.active_dataset()['W']
+    for var in ['Income', 'PCR']:
+        y = np.asarray(webstars.get_array(var), dtype = float)
+        grid = webstars.spatial_markov_grid(var, range(1, 10), [3, 6, 9])
+        different = []
+        for (k, m), markov in sorted(grid.items()):
+            reference = giddy.markov.Spatial_Markov(y, copy.deepcopy(w), fixed = True, k = k, m = m)
+            same = np.allclose(reference.p, markov['p']) and np.allclose(reference.P, markov['P']) and np.allclose(reference.T, markov['T'])
+            if k > 1: same = same and np.isclose(mobility.markov_mobility(reference.p, measure = 'P'), markov['shorrock_1'])
+            if not same: different.append((k, m))
+        check('Spatial Markov of {} (k in 1..9, m in 3, 6, 9){}'.format(var, '' if not different else ': ' + str(different)), not different)
+
+# Global and local Moran of every year against esda.Moran and esda.Moran_Local
+def check_moran():
+    w = webstars.active_dataset()['W']
+    for var in ['Income', 'PCR']:
+        y = np.asarray(webstars.get_array(var), dtype = float)
+        years = range(y.shape[1])
+
+        moran = webstars.moran_series(var, permutations = 0)
+        check("Moran's I of {} (every year)".format(var), np.allclose(moran['I'], [esda.Moran(y[:, j], copy.deepcopy(w), permutations = 0).I for j in years]))
+
+        lisa = webstars.local_moran_series(var, permutations = 0)
+        references = [esda.Moran_Local(y[:, j], copy.deepcopy(w), permutations = 0) for j in years]
+        check('Local Moran Is of {} (every year)'.format(var), all(np.allclose(lisa['Is'][:, j], references[j].Is) for j in years))
+        check('Local Moran quadrants of {} (every year)'.format(var), all(np.array_equal(lisa['q'][:, j], references[j].q) for j in years))
+
+# Spatial tau and neighbor set LIMA (the engine and the all-pairs store) against giddy.rank.SpatialTau and Tau_Local_Neighbor
+def check_lima():
+    w_binary = webstars.active_dataset()['W_binary']
+    years = webstars.active_dataset()['years']
+    y = np.asarray(webstars.get_array('PCR'), dtype = float)
+    for c0, c1 in [(0, len(years) - 1), (0, 1), (20, 50)]:
+        tau = giddy.rank.SpatialTau(y[:, c0], y[:, c1], copy.deepcopy(w_binary), 0)
+        neighbor = giddy.rank.Tau_Local_Neighbor(y[:, c0], y[:, c1], copy.deepcopy(w_binary), 0)
+        for name, result in [('engine', webstars.lima(y[:, c0], y[:, c1], permutations = 0)), ('store', webstars.lima_lookup(years[c0], years[c1]))]:
+            check('LIMA {} between {} and {}'.format(name, years[c0], years[c1]),
+                  np.isclose(result['tau_spatial'], tau.tau_spatial, atol = 1e-6) and np.allclose(result['tau_ln'], neighbor.tau_ln, atol = 1e-6))
+
+# Queen and rook contiguity, KNN and distance band weights against libpysal, compared as neighbor sets (libpysal does not sort its lists)
+def check_weights():
+    neighbor_sets = lambda indptr, indices: [set(indices[indptr[i]:indptr[i + 1]].tolist()) for i in range(len(indptr) - 1)]
+    w_sets = lambda w: [set(w.neighbors[i]) for i in w.id_order]
+    for name in ['us48.shp', 'columbus.shp']:
+        df = gpd.read_file(libpysal.examples.get_path(name))
+        geometries = list(df.geometry)
+        check('Queen contiguity of {}'.format(name), neighbor_sets(*webstars.contiguity_csr(geometries)) == w_sets(libpysal.weights.Queen.from_dataframe(df, use_index = False)))
+        check('Rook contiguity of {}'.format(name), neighbor_sets(*webstars.contiguity_csr(geometries, rook = True)) == w_sets(libpysal.weights.Rook.from_dataframe(df, use_index = False)))
+        
+        centroids = np.array([[geom.centroid.x, geom.centroid.y] for geom in geometries])
+        check('KNN (k = 4) of {}'.format(name), neighbor_sets(*webstars.knn_csr(centroids, 4)) == w_sets(libpysal.weights.KNN(centroids, k = 4)))
+        threshold = 1.5 * libpysal.weights.min_threshold_distance(centroids)
+        band = libpysal.weights.DistanceBand(centroids, threshold, binary = True, silence_warnings = True)
+        check('Distance band of {}'.format(name), neighbor_sets(*webstars.distance_band_csr(centroids, threshold)) == w_sets(band))
+
+if __name__ == '__main__':
+    entry = webstars.dataset_entry(webstars.default_dataset_id)
+    for check_engine in [check_markov, check_moran, check_lima]:
+        webstars.with_dataset(entry, check_engine)
+    check_weights()
+    print('{} mismatches'.format(len(mismatches)))
+    sys.exit(1 if mismatches else 0)